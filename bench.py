@@ -0,0 +1,306 @@
+"""
+Headless benchmark suite for source transforms, mask builders and simple_bitmask_swap.
+    Times each operation on synthetic images over a range of sizes and aspect ratios,
+    reports median/p95 latency and throughput, and optionally writes the results to JSON
+    and compares them against a stored baseline.
+
+Usage:
+    python bench.py --out bench.json
+    python bench.py --baseline bench.json --threshold 0.15   # Exits with 1 on a regression
+    python bench.py --calibrate     # Measure the transform cost model used by chaos_source_transform
+    python bench.py --import-time   # Check the import time of main (what every pool worker pays) against a budget
+"""
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from PIL import ImageDraw
+from source_ops import *
+
+SIZES = [512, 1024, 2048]  # Length of the short side, in px
+ASPECTS = [1.0, 4 / 3, 3 / 4, 16 / 9]  # w / h
+REPS = 15
+WARMUP = 1
+SEED = 0
+THRESHOLD = 0.10  # Slowdown of the median, as a fraction of the baseline, that counts as a regression
+MIN_COMPARE_MS = 0.05  # Cases faster than this in the baseline are too noisy to compare
+CALIBRATION_ASPECTS = [1.0, 16 / 9]
+CALIBRATION_REPS = 7
+IMPORT_BUDGET_MS = 400  # Cumulative import time allowed for IMPORT_MODULE, in a fresh interpreter
+IMPORT_MODULE = 'main'
+IMPORT_RUNS = 3  # Best of, since the first import after a change also pays for writing bytecode
+# Dependencies that must only be imported once they are used (plots, AVIF conversion, prep(), the GUI runner)
+LAZY_MODULES = ['matplotlib', 'pillow_avif', 'sortedcontainers', 'PySimpleGUI']
+
+
+def make_synthetic_im_arr(short_side, aspect, seed=SEED):
+    """
+    Build a random RGB image array, with aspect = w / h
+
+    :param int short_side:
+    :param float aspect:
+    :param int seed:
+    :return np.ndarray:
+    """
+    if aspect >= 1:
+        h, w = short_side, round(short_side * aspect)
+    else:
+        h, w = round(short_side / aspect), short_side
+    return np.random.default_rng(seed).integers(0, 256, size=(h, w, 3), dtype=np.uint8)
+
+
+def make_synthetic_mask_file(dirname):
+    """
+    Save a black-on-white mask image to use with build_bitmask_from_image
+
+    :param str dirname:
+    :return str:    Path of the mask image
+    """
+    mask_img = Image.new('RGB', (400, 400), (255, 255, 255))
+    ImageDraw.Draw(mask_img).ellipse((50, 50, 350, 350), fill=(0, 0, 0))
+    path = os.path.join(dirname, 'bench_mask.png')
+    mask_img.save(path)
+    return path
+
+
+def clear_mask_caches():
+    """Forget every cached bitmask and fit size, so mask builders are timed cold"""
+    BITMASK_CACHE.clear()
+    FIT_SIZE_CACHE.clear()
+
+
+def get_bench_cases(im_arr, mask_path, seed=SEED):
+    """
+    Return the operations to time on im_arr.
+        Randomized transforms draw from an RNG seeded the same way on every run,
+        so a run makes the same random choices as the baseline it is compared against
+
+    :param np.ndarray im_arr:
+    :param str mask_path:   See make_synthetic_mask_file
+    :param int seed:
+    :return list(tuple):    (name, fn, setup) for profile_sample_times
+    """
+    w, h = get_np_array_shape(im_arr)
+    im_arr_2 = im_arr[::-1, ::-1].copy()
+
+    cases = []
+    for transform in ALL_TRANSFORMS:
+        fn = functools.partial(transform, im_arr)
+        if 'rng' in inspect.signature(transform).parameters:
+            fn = functools.partial(transform, im_arr, rng=random.Random(seed))
+        cases.append((transform.__name__, fn, None))
+
+    cases.append(('build_bitmask_to_size',
+                  lambda: build_bitmask_to_size(text='D', fontfile=BOOKMAN, shape=(w, h)),
+                  clear_mask_caches))
+    rng = random.Random(seed)
+    cases.append(('build_random_text_bitmask',
+                  lambda: build_random_text_bitmask(fontfile=BOOKMAN, shape=(w, h), rng=rng),
+                  clear_mask_caches))
+    cases.append(('build_bitmask_from_image',
+                  lambda: build_bitmask_from_image(mask_path, (w, h)),
+                  clear_mask_caches))
+
+    bitmask = build_bitmask_to_size(text='D', fontfile=BOOKMAN, shape=(w, h))
+    cases.append(('simple_bitmask_swap', lambda: simple_bitmask_swap(im_arr, im_arr_2, bitmask), None))
+    return cases
+
+
+def run_benchmarks(sizes=SIZES, aspects=ASPECTS, reps=REPS, warmup=WARMUP, seed=SEED, name_filter=None,
+                   names=None):
+    """
+    Time every benchmark case at every size and aspect ratio
+
+    :param list(int) sizes:
+    :param list(float) aspects:
+    :param int reps:
+    :param int warmup:
+    :param int seed:
+    :param str name_filter:     If given, only run cases whose name contains it
+    :param set(str) names:      If given, only run cases with these names
+    :return dict:               Results keyed by "<name>@<w>x<h>"
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mask_path = make_synthetic_mask_file(tmp_dir)
+        for short_side in sizes:
+            for aspect in aspects:
+                im_arr = make_synthetic_im_arr(short_side, aspect, seed)
+                w, h = get_np_array_shape(im_arr)
+                megapixels = w * h / 1e6
+                for name, fn, setup in get_bench_cases(im_arr, mask_path, seed):
+                    if (name_filter and name_filter not in name) or (names and name not in names):
+                        continue
+                    times = profile_sample_times(fn, reps=reps, warmup=warmup, setup=setup)
+                    result = dict(name=name, w=w, h=h, **profile_summarize_times(times, megapixels))
+                    results[f'{name}@{w}x{h}'] = result
+                    logger.info(f"{name:<36} {w:>5}x{h:<5} median {result['median_ms']:9.2f}ms   "
+                                f"p95 {result['p95_ms']:9.2f}ms   {result['mp_per_s']:8.1f} MP/s")
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold=THRESHOLD):
+    """
+    Return the cases whose median time grew by more than <threshold> over the baseline.
+        Cases missing from either side, or faster than MIN_COMPARE_MS in the baseline, are skipped
+
+    :param dict results:    See run_benchmarks
+    :param dict baseline:   Results of an earlier run
+    :param float threshold:
+    :return list(tuple):    (key, baseline median_ms, median_ms, ratio), worst first
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base or base['median_ms'] < MIN_COMPARE_MS:
+            continue
+        ratio = result['median_ms'] / base['median_ms']
+        if ratio > 1 + threshold:
+            regressions.append((key, base['median_ms'], result['median_ms'], ratio))
+    return sorted(regressions, key=lambda regression: regression[3], reverse=True)
+
+
+def calibrate_transform_costs(sizes=SIZES, aspects=CALIBRATION_ASPECTS, reps=CALIBRATION_REPS, seed=SEED):
+    """
+    Measure every transform in ALL_TRANSFORMS over several image sizes and fit its p95 time as
+        overhead_ms + ms_per_mp * megapixels. The p95 rather than the median, since transforms with
+        random parameters (e.g. source_offcrop_recursive) vary a lot from call to call
+
+    :param list(int) sizes:
+    :param list(float) aspects:
+    :param int reps:
+    :param int seed:
+    :return dict:   transform name -> {'overhead_ms': float, 'ms_per_mp': float}
+    """
+    results = run_benchmarks(sizes, aspects, reps, seed=seed, names={t.__name__ for t in ALL_TRANSFORMS})
+
+    samples = defaultdict(list)
+    for result in results.values():
+        samples[result['name']].append((result['w'] * result['h'] / 1e6, result['p95_ms']))
+
+    model = {}
+    for name, points in samples.items():
+        megapixels, times = map(np.array, zip(*points))
+        if len(set(megapixels)) > 1:
+            ms_per_mp, overhead_ms = np.polyfit(megapixels, times, 1)
+        else:
+            ms_per_mp, overhead_ms = times.max() / megapixels.max(), 0.0
+        model[name] = {'overhead_ms': max(float(overhead_ms), 0.0), 'ms_per_mp': max(float(ms_per_mp), 0.0)}
+    return model
+
+
+def measure_import_time(module=IMPORT_MODULE, runs=IMPORT_RUNS):
+    """
+    Import module in fresh interpreters run with `-X importtime` and keep the fastest run
+
+    :param str module:
+    :param int runs:
+    :return tuple:  (cumulative ms, {imported module: cumulative ms}) of the fastest run
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                              cwd=repo_dir, capture_output=True, text=True, check=True)
+        imports = {}
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative_us, name = line.split('|')
+            imports[name.strip()] = int(cumulative_us) / 1000
+        if best is None or imports[module] < best[1][module]:
+            best = (imports[module], imports)
+    return best
+
+
+def check_import_time(module=IMPORT_MODULE, budget_ms=IMPORT_BUDGET_MS, top=10):
+    """
+    Log the slowest imports under module, and check that it imports within budget_ms without loading LAZY_MODULES
+
+    :param str module:
+    :param float budget_ms:
+    :param int top:         Number of slowest imports to log
+    :return bool:           True if within budget
+    """
+    total_ms, imports = measure_import_time(module)
+    for name, ms in sorted(imports.items(), key=lambda item: item[1], reverse=True)[:top]:
+        logger.info(f"{name:<48} {ms:8.1f}ms")
+
+    ok = True
+    eager = [name for name in LAZY_MODULES if name in imports]
+    if eager:
+        logger.warning(f"import {module} loads {', '.join(eager)}, which should only be imported on use")
+        ok = False
+    if total_ms > budget_ms:
+        logger.warning(f"import {module} took {total_ms:.1f}ms, over the {budget_ms:.0f}ms budget")
+        ok = False
+    else:
+        logger.info(f"import {module} took {total_ms:.1f}ms, within the {budget_ms:.0f}ms budget")
+    return ok
+
+
+def parse_list(text, cast):
+    return [cast(item) for item in text.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=lambda t: parse_list(t, int), default=SIZES,
+                        help='Comma-separated short-side lengths, in px')
+    parser.add_argument('--aspects', type=lambda t: parse_list(t, float), default=ASPECTS,
+                        help='Comma-separated aspect ratios (w / h)')
+    parser.add_argument('--reps', type=int, default=REPS)
+    parser.add_argument('--warmup', type=int, default=WARMUP)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--filter', dest='name_filter', help='Only run cases whose name contains this')
+    parser.add_argument('--out', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Slowdown of the median, as a fraction of the baseline, that counts as a regression')
+    parser.add_argument('--calibrate', action='store_true',
+                        help=f'Measure the transform cost model instead, and save it to {TRANSFORM_COST_MODEL_PATH}')
+    parser.add_argument('--import-time', action='store_true',
+                        help=f'Check the import time of {IMPORT_MODULE} instead, exiting with 1 if over budget')
+    parser.add_argument('--import-budget-ms', type=float, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    if args.import_time:
+        return 0 if check_import_time(budget_ms=args.import_budget_ms) else 1
+    if args.calibrate:
+        model = calibrate_transform_costs(args.sizes, seed=args.seed)
+        meta = dict(sizes=args.sizes, python=platform.python_version(), numpy=np.__version__,
+                    machine=platform.machine(), time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        save_transform_cost_model(model, meta=meta)
+        for name, cost in sorted(model.items(), key=lambda item: item[1]['ms_per_mp'], reverse=True):
+            logger.info(f"{name:<36} {cost['ms_per_mp']:9.2f}ms/MP + {cost['overhead_ms']:7.2f}ms")
+        logger.info(f"Saved the transform cost model to {TRANSFORM_COST_MODEL_PATH}")
+        return 0
+
+    results = run_benchmarks(args.sizes, args.aspects, args.reps, args.warmup, args.seed, args.name_filter)
+
+    if args.out:
+        meta = dict(reps=args.reps, warmup=args.warmup, seed=args.seed, python=platform.python_version(),
+                    numpy=np.__version__, machine=platform.machine(), time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        with open(args.out, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        logger.info(f"Wrote {len(results)} results to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        for key, base_ms, ms, ratio in regressions:
+            logger.warning(f"REGRESSION {key}: {base_ms:.2f}ms -> {ms:.2f}ms ({ratio:.2f}x)")
+        if regressions:
+            return 1
+        logger.info(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,13 @@
+"""
+Headless entry point: takes main's arguments from the command line instead of the PySimpleGUI runner,
+    so batches can be scripted or scheduled on machines without a display
+
+Usage:
+    python cli.py --help
+    python cli.py --iters 20 --bitmask-method RANDOM_TEXT --spec-srcs 17,42 --no-use-latest
+"""
+from main import *
+
+
+if __name__ == '__main__':
+    start(fn_cli)
@@ -0,0 +1,127 @@
+"""
+Local load generator for service.py.
+    Runs a number of concurrent clients that each send /render requests back to back,
+    then reports latency percentiles, throughput and response codes (503 means the service's queue was full)
+
+Usage:
+    python loadgen.py --clients 8 --requests 200
+    python loadgen.py --texts D,LOVE,NYC --method RANDOM_TEXT --out load.json
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter
+
+URL = 'http://127.0.0.1:8008'
+CLIENTS = 8
+REQUESTS = 200
+TEXTS = ['D', 'LOVE', 'NYC', 'OCD']
+TIMEOUT_S = 120
+
+
+def send_render_request(url, body, timeout=TIMEOUT_S):
+    """
+    :param str url:     Base URL of the service
+    :param dict body:   See service.parse_render_request
+    :param float timeout:
+    :return (int, float, int):  Status, seconds taken, bytes received
+    """
+    request = urllib.request.Request(f'{url}/render', data=json.dumps(body).encode(),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            data = response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        data = e.read()
+        status = e.code
+    return status, time.perf_counter() - start, len(data)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def run_load(url=URL, clients=CLIENTS, requests=REQUESTS, texts=TEXTS, method='STATIC_TEXT', seed=0):
+    """
+    Send <requests> render requests from <clients> concurrent threads
+
+    :param str url:
+    :param int clients:
+    :param int requests:
+    :param list(str) texts:     Each request picks one at random
+    :param str method:          BitmaskMethod name
+    :param int seed:
+    :return dict:               Summary of the run
+    """
+    results = []
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def client(client_id):
+        rng = random.Random(seed * 1000 + client_id)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            body = {'text': rng.choice(texts), 'bitmask_method': method, 'seed': rng.getrandbits(32)}
+            try:
+                result = send_render_request(url, body)
+            except OSError as e:
+                result = (type(e).__name__, 0.0, 0)
+            with lock:
+                results.append(result)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    ok_latencies = [seconds * 1000 for status, seconds, _ in results if status == 200]
+    summary = {
+        'clients': clients,
+        'requests': len(results),
+        'elapsed_s': elapsed,
+        'ok_per_s': len(ok_latencies) / elapsed if elapsed else 0.0,
+        'responses': {str(status): count for status, count in Counter(r[0] for r in results).items()},
+        'mean_bytes': (sum(r[2] for r in results if r[0] == 200) / len(ok_latencies)) if ok_latencies else 0,
+    }
+    if ok_latencies:
+        summary['latency_ms'] = {f'p{p}': percentile(ok_latencies, p) for p in (50, 95, 99)}
+        summary['latency_ms']['max'] = max(ok_latencies)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default=URL)
+    parser.add_argument('--clients', type=int, default=CLIENTS)
+    parser.add_argument('--requests', type=int, default=REQUESTS)
+    parser.add_argument('--texts', type=lambda t: [x for x in t.split(',') if x], default=TEXTS)
+    parser.add_argument('--method', default='STATIC_TEXT', help='BitmaskMethod name')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='Also write the summary to this JSON file')
+    args = parser.parse_args(argv)
+
+    summary = run_load(args.url, args.clients, args.requests, args.texts, args.method, args.seed)
+    print(json.dumps(summary, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 0 if summary['responses'].get('200') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
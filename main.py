@@ -1,5 +1,6 @@
 from util import *
 from enum import Enum
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from util import BitmaskMethod
 
 # Options
@@ -11,6 +12,16 @@ DRAW_HANDLE = False
 KERN_RATE = 1.0
 ITERS = 5
 SPEC_SRCS = []
+USE_SOURCE_STORE = False  # Memory-map pre-decoded sources (see util.enable_source_store)
+MIN_SOURCE_SIZE = 0  # If > 0, only pick sources whose square crop is at least this many px (judged without decoding)
+TARGET_SIZE = 0  # If > 0, sources may be decoded at reduced resolution, down to this many px per side
+WORKERS = 1  # If > 1, iterations are rendered in parallel by a pool of this many processes
+WRITER_THREADS = 2  # Threads encoding and saving collages in the background, when rendering in this process
+TIME_BUDGET_MS = 0  # If > 0, chaos transforms are picked to fit this many ms per source (see bench.py --calibrate)
+SEED = 0  # If > 0, replay the run that logged this seed. Otherwise draw a fresh one
+INSTRUMENT = False  # Record per-stage timings and counts (see tools.STAGE_STATS), summarized at the end of the run
+TRACE_MEMORY = False  # When instrumenting, also record bytes allocated per stage. Slows rendering down noticeably
+STAGE_STATS_PATH = os.path.join(CACHE_DIR, 'stage_stats.json')
 
 
 def main(mask:str=MASK,
@@ -21,37 +32,167 @@ def main(mask:str=MASK,
          kern_rate:float=KERN_RATE,
          iters:int=ITERS,
          spec_srcs:list=SPEC_SRCS,
+         min_source_size:int=MIN_SOURCE_SIZE,
+         target_size:int=TARGET_SIZE,
+         workers:int=WORKERS,
+         time_budget_ms:int=TIME_BUDGET_MS,
+         seed:int=SEED,
+         instrument:bool=INSTRUMENT,
          ):
 
-    mask_img = Image.open(mask)
-    bitmask = None
+    if not seed:
+        seed = np.random.SeedSequence().entropy
+    logger.info(f"Run seed: {seed}")
+    seeds = get_iteration_seeds(seed, iters)
+
+    render_kwargs = dict(mask=mask, text=text, bitmask_method=bitmask_method, use_latest=use_latest,
+                         kern_rate=kern_rate, spec_srcs=spec_srcs, min_source_size=min_source_size,
+                         target_size=target_size, time_budget_ms=time_budget_ms or None)
+
+    if instrument:
+        STAGE_STATS.reset()
+        STAGE_STATS.enable(trace_memory=TRACE_MEMORY)
+    try:
+        if workers > 1:
+            render_batch_parallel(seeds, workers, draw_handle, **render_kwargs)
+            return
+
+        # Saving happens in the background, overlapping with the next iteration's rendering
+        with ImageWriter(num_threads=WRITER_THREADS) as writer:
+            for iteration, iter_seed in enumerate(seeds):
+                STAGE_STATS.set_iteration(iteration)
+                rng = random.Random(iter_seed)  # Handed off to the writer along with the collages
+                collages = render_collages(rng=rng, **render_kwargs)
+                writer.submit(collages, draw_handle=draw_handle, rng=rng, pool=BUFFER_POOL)
+    finally:
+        if instrument:
+            STAGE_STATS.disable()
+            dump_stage_stats(STAGE_STATS_PATH)
+
+
+def dump_stage_stats(path):
+    """
+    Log the per-stage totals recorded in STAGE_STATS, slowest first, and write the full summary to JSON
+        along with this process's BUFFER_POOL stats
+
+    :param str path:
+    :return dict:   See StageStats.summary
+    """
+    summary = STAGE_STATS.summary()
+    for name, total in summary['stages'].items():
+        peak = f"{total['peak_bytes'] / 2**20:8.1f}MiB" if total['peak_bytes'] is not None else f"{'n/a':>11}"
+        logger.info(f"{name:<36} {total['calls']:>5} calls   {total['ms']:10.1f}ms total   "
+                    f"{total['max_iteration_ms']:9.1f}ms worst iter   {peak} peak")
+    summary['buffer_pool'] = pool_stats = BUFFER_POOL.stats()
+    logger.info(f"Buffer pool: {pool_stats['reuses']}/{pool_stats['takes']} takes reused   "
+                f"{pool_stats['peak_bytes'] / 2**20:.1f}MiB peak pooled")
 
-    for x in range(iters):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    logger.info(f"Stage stats written to {path}")
+    return summary
 
-        # Get Source Images
-        imgs, filenames = load_sources(latest=use_latest, specific_srcs=spec_srcs)
-        imarr_1, imarr_2 = imgs
 
-        imarr_1, op_list = chaos_source_transform(imarr_1)
-        imarr_2, op_list = chaos_source_transform(imarr_2)
+def get_iteration_seeds(seed, iters):
+    """
+    Derive one independent seed per iteration from the run seed.
+        Iteration i of a run renders the same collages whether it runs here or in a worker process
 
-        crop_shape = get_common_crop_shape([imarr_1, imarr_2], square=True)
-        imarr_1 = crop_im_arr(imarr_1, cropbox_central_shape, crop_shape=crop_shape)
-        imarr_2 = crop_im_arr(imarr_2, cropbox_central_shape, crop_shape=crop_shape)
+    :param int seed:
+    :param int iters:
+    :return list(int):
+    """
+    return [int(seed_seq.generate_state(1)[0]) for seed_seq in np.random.SeedSequence(seed).spawn(iters)]
 
-        # Generate Bitmask
-        match bitmask_method:
-            case BitmaskMethod.BITMASK_IMG:
-                mask_img = mask_img.resize(crop_shape)
-                bitmask = make_bitmask_from_bw_image(mask_img)
-            case BitmaskMethod.STATIC_TEXT:
-                bitmask = build_bitmask_to_size(text=text, fontfile=BOOKMAN, shape=crop_shape, kern_rate=kern_rate)
-            case BitmaskMethod.RANDOM_TEXT:
-                bitmask = build_random_text_bitmask(fontfile=BOOKMAN, shape=crop_shape)
 
-        # Apply Bitmask to Source Images
-        collage_A, collage_B = simple_bitmask_swap(imarr_1, imarr_2, bitmask)
-        save_images_from_arrays([collage_A, collage_B], draw_handle=draw_handle)
+def render_iteration(draw_handle, seed, **render_kwargs):
+    """
+    Render one pair of collages and save them to ./output
+
+    :param bool draw_handle:
+    :param int seed:    Seeds the iteration's random.Random
+    :return list(str):  Paths of the saved collages
+    """
+    rng = random.Random(seed)
+    collages = render_collages(rng=rng, **render_kwargs)
+    paths = save_images_from_arrays(collages, draw_handle=draw_handle, rng=rng)
+    BUFFER_POOL.give(*collages)
+    return paths
+
+
+def render_collages(mask, text, bitmask_method, use_latest, kern_rate, spec_srcs, target_size, min_source_size=0,
+                    time_budget_ms=None, rng=None, pool=BUFFER_POOL):
+    """
+    Render one pair of collages
+
+    :param float time_budget_ms:    Per source, see chaos_source_transform
+    :param random.Random rng:   Source of randomness, defaults to the global random module
+    :param BufferPool pool:     Where the scratch and output arrays come from, None to allocate fresh ones.
+                                    Give the collages back to it once they're saved
+    :return list(np.ndarray):
+    """
+    # Get Source Images
+    imgs, filenames = load_sources(latest=use_latest, specific_srcs=spec_srcs, target_size=target_size,
+                                   min_size=min_source_size, rng=rng)
+    imarr_1, imarr_2 = imgs
+
+    transformed_1, op_list = chaos_source_transform(imarr_1, rng=rng, time_budget_ms=time_budget_ms, pool=pool)
+    transformed_2, op_list = chaos_source_transform(imarr_2, rng=rng, time_budget_ms=time_budget_ms, pool=pool)
+
+    crop_shape = get_common_crop_shape([transformed_1, transformed_2], square=True)
+    imarr_1 = crop_im_arr(transformed_1, cropbox_central_shape, crop_shape=crop_shape)
+    imarr_2 = crop_im_arr(transformed_2, cropbox_central_shape, crop_shape=crop_shape)
+
+    # Generate Bitmask
+    bitmask = None
+    match bitmask_method:
+        case BitmaskMethod.BITMASK_IMG:
+            bitmask = build_bitmask_from_image(mask, crop_shape)
+        case BitmaskMethod.STATIC_TEXT:
+            bitmask = build_bitmask_to_size(text=text, fontfile=BOOKMAN, shape=crop_shape, kern_rate=kern_rate)
+        case BitmaskMethod.RANDOM_TEXT:
+            bitmask = build_random_text_bitmask(fontfile=BOOKMAN, shape=crop_shape, rng=rng)
+
+    # Apply Bitmask to Source Images
+    out = (pool.take(imarr_1.shape, imarr_1.dtype), pool.take(imarr_2.shape, imarr_2.dtype)) if pool else None
+    collage_A, collage_B = simple_bitmask_swap(imarr_1, imarr_2, bitmask, out=out)
+    if pool:
+        pool.give(transformed_1, transformed_2)
+    return [collage_A, collage_B]
+
+
+def render_batch_parallel(seeds, workers, draw_handle, **render_kwargs):
+    """
+    Spread one render_iteration() call per seed across a pool of <workers> processes.
+        Results are logged as they finish, in whatever order that is.
+        If STAGE_STATS is enabled, each worker's records are merged into it under their iteration
+
+    :param list(int) seeds:     One per iteration, see get_iteration_seeds
+    :param int workers:
+    :param bool draw_handle:
+    :return list(str):      Paths of all saved collages
+    """
+    iters = len(seeds)
+    saved_paths = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_render_worker,
+                             initargs=get_render_worker_state()) as pool:
+        futures = {}
+        for iteration, seed in enumerate(seeds):
+            if STAGE_STATS.enabled:
+                future = pool.submit(capture_stage_stats, render_iteration, draw_handle, seed=seed, **render_kwargs)
+            else:
+                future = pool.submit(render_iteration, draw_handle, seed=seed, **render_kwargs)
+            futures[future] = iteration
+        for done, future in enumerate(as_completed(futures), start=1):
+            paths = future.result()
+            if STAGE_STATS.enabled:
+                paths, records = paths  # See capture_stage_stats
+                STAGE_STATS.merge(records, iteration=futures[future])
+            saved_paths.extend(paths)
+            logger.info(f"[{done}/{iters}] Saved {', '.join(paths)}")
+    return saved_paths
+
 
 '''Flags'''
 # TODO Slice Transform: swap slices between 2 or more sources
@@ -99,9 +240,30 @@ def main(mask:str=MASK,
 # TODO weave two sources by using a checkerboard pattern for the mask
 
 
-if __name__ == '__main__':
+def setup():
+    """
+    Index the sources and set up the source and fit-size stores, as every entry point must before rendering
+    :return:
+    """
+    if USE_SOURCE_STORE:
+        enable_source_store()
     prep()
-    fn_runner(main)
+    enable_fit_size_store()
+
+
+def start(runner):
+    """
+    Have runner collect main's arguments, then set up and call main.
+        Setup waits for the arguments, since it indexes the sources and writes to CACHE_DIR
+
+    :param function runner: util.fn_runner (GUI) or util.fn_cli (headless, see cli.py)
+    :return:
+    """
+    runner(main, prepare=setup)
+
+
+if __name__ == '__main__':
+    start(fn_runner)
 
 '''
 Big Goals
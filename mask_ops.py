@@ -1,23 +1,115 @@
 """
 Library module for mask-related operations
 """
+import json
 from PIL import Image, ImageDraw, ImageFont
 from tools import *
 
-def build_random_text_bitmask(fontfile, shape, numchars:int=None):
+# In-memory memo of fit_text_to_shape() results, keyed by (text, fontfile, (w, h), kern_rate)
+FIT_SIZE_CACHE = LRUCache(max_entries=4096)
+# Path of the on-disk fit-size store. None means the store is disabled (see enable_fit_size_store)
+FIT_SIZE_STORE = None
+FIT_SIZE_STORE_PATH = os.path.join(CACHE_DIR, 'fit_sizes.jsonl')
+FIT_SIZE_STORE_LOCK = threading.Lock()  # Serializes this process's appends to the store
+# The store is compacted down to its latest entries when enabled with more than this many
+FIT_SIZE_STORE_MAX_ENTRIES = 4096
+# Whitespace drawn around text images, on every side
+MAX_PADDING = 18
+
+# Process-wide pool of loaded fonts, keyed by (font path, fontsize). See get_font()
+FONT_POOL = LRUCache(max_entries=128)
+
+# Bitmasks already rasterized, stored bit-packed (see pack_bitmask) and keyed by get_bitmask_key().
+#   Adjust the memory budget with BITMASK_CACHE.resize(max_bytes=...)
+BITMASK_CACHE_BYTES = 256 * 1024 * 1024
+BITMASK_CACHE = LRUCache(max_entries=4096, max_bytes=BITMASK_CACHE_BYTES,
+                         sizeof=lambda packed_entry: packed_entry[0].nbytes)
+
+class PaddedBitmask:
+    """
+    Bitmask stored as the tight raster around its set pixels, plus the raster's offset in the full shape.
+        Every pixel outside the raster is False. A text bitmask is mostly margin, so simple_bitmask_swap
+        only needs to run the masked select inside bbox.
+        np.asarray() materializes the full (h, w, 1) bitmask for code that needs every pixel
+    """
+    def __init__(self, raster, offset, full_shape):
+        """
+        :param np.ndarray raster:       (bh, bw, 1) bool
+        :param tuple(int) offset:       (top, left) of the raster in the full bitmask
+        :param tuple(int) full_shape:   (h, w) of the full bitmask
+        """
+        self.raster = raster
+        self.offset = tuple(offset)
+        self.full_shape = tuple(full_shape)
+
+    @property
+    def shape(self):
+        return self.full_shape + self.raster.shape[2:]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.raster.dtype
+
+    @property
+    def bbox(self):
+        """
+        :return tuple(slice):   Rows and columns of the full bitmask covered by the raster
+        """
+        top, left = self.offset
+        h, w = self.raster.shape[:2]
+        return slice(top, top + h), slice(left, left + w)
+
+    def __array__(self, dtype=None, copy=None):
+        bitmask = np.zeros(self.shape, dtype=bool)
+        bitmask[self.bbox] = self.raster
+        return bitmask if dtype is None else bitmask.astype(dtype)
+
+
+def get_font(fontfile, fontsize):
+    """
+    Return the FreeTypeFont for fontfile at fontsize, loading it into FONT_POOL on first use
+
+    :param str fontfile:    Name of the font file stored in FONT_DIR (or an absolute path)
+    :param int fontsize:
+    :return ImageFont.FreeTypeFont:
+    """
+    key = (os.path.join(FONT_DIR, fontfile), fontsize)
+    font_obj = FONT_POOL.get(key)
+    if font_obj is None:
+        font_obj = ImageFont.truetype(*key)
+        FONT_POOL.put(key, font_obj)
+    return font_obj
+
+
+def get_font_pool_stats():
+    """
+    :return dict:   Hit/miss counters and current size of FONT_POOL
+    """
+    return {'hits': FONT_POOL.hits, 'misses': FONT_POOL.misses, 'fonts': len(FONT_POOL)}
+
+
+@instrument_stage()
+def build_random_text_bitmask(fontfile, shape, numchars:int=None, rng=None):
     """
 
     :param fontfile:
     :param shape:
     :param numchars:
-    :return np.ndarray:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
+    :return PaddedBitmask:
     """
+    rng = get_rng(rng)
     if not numchars:
         numchars = 4
-    k = math.floor(random.random() * numchars) + 1
-    text = build_random_string(k=k)
-    kern_rate = random.uniform(0.75, 1.0)
-    bitmask = build_bitmask_to_size(text, fontfile=fontfile, shape=shape, kern_rate=kern_rate)
+    k = math.floor(rng.random() * numchars) + 1
+    text = build_random_string(k=k, rng=rng)
+    kern_rate = rng.uniform(0.75, 1.0)
+    # Random text and kern_rate practically never repeat, so their fit sizes aren't worth keeping
+    bitmask = build_bitmask_to_size(text, fontfile=fontfile, shape=shape, kern_rate=kern_rate, cache=False)
     return bitmask
 
 
@@ -36,21 +128,15 @@ def build_mask_from_text(text, fontfile, fontsize, kern_rate):
         for providing a method to kern text one character at a time
 
     """
-    MAX_PADDING = 18
-
-    # Create a Font object from the .ttf
-    fontfile = os.path.join(FONT_DIR, fontfile)
-    font_obj = ImageFont.truetype(fontfile, fontsize)
+    # Get a Font object for the .ttf
+    font_obj = get_font(fontfile, fontsize)
 
     # Determine the text's dimensions when printing to image
     left, top, right, bottom = font_obj.getbbox(text)
-    text_height = bottom - top
     char_widths = get_char_widths(text, font_obj)
-    kerned_width = int(kern_rate * sum(char_widths[:-1])) + char_widths[-1]
 
     # Create a new Image, which will serve as the canvas for drawing the image
-    text_image = Image.new(
-        mode='RGB', size=(kerned_width + (MAX_PADDING * 2), text_height + (MAX_PADDING * 2)), color=Colors.WHITE)
+    text_image = Image.new(mode='RGB', size=measure_text_box(text, font_obj, kern_rate), color=Colors.WHITE)
     # Create a 'Drawing Pad' which will draw text to your image canvas
     draw = ImageDraw.Draw(text_image)
 
@@ -63,37 +149,224 @@ def build_mask_from_text(text, fontfile, fontsize, kern_rate):
     return text_image
 
 
-def build_bitmask_to_size(text, fontfile, shape, kern_rate=1.0):
+def measure_text_box(text, font_obj, kern_rate):
     """
-    Generate Image.Image from text and font, to fit the given shape (w, h)
+    Compute the (w, h) of the image build_mask_from_text() would draw, from font metrics alone
+
+    :param str text:
+    :param ImageFont.FreeTypeFont font_obj:
+    :param float kern_rate:
+    :return tuple(int):
+    """
+    left, top, right, bottom = font_obj.getbbox(text)
+    text_height = bottom - top
+    char_widths = get_char_widths(text, font_obj)
+    kerned_width = int(kern_rate * sum(char_widths[:-1])) + char_widths[-1]
+    return kerned_width + (MAX_PADDING * 2), text_height + (MAX_PADDING * 2)
+
+
+@instrument_stage()
+def build_bitmask_to_size(text, fontfile, shape, kern_rate=1.0, cache=True):
+    """
+    Generate a bitmask from text and font, to fit the given shape (w, h).
+        Bitmasks are cached in BITMASK_CACHE, so repeated calls skip rasterizing
+
     :param str text:
     :param str fontfile: Name of the font file stored in FONT_DIR
     :param tuple(int) shape:
     :param float kern_rate:
-    :return Image.Image :
+    :param bool cache:  False for one-off text, which skips BITMASK_CACHE too (see fit_text_to_shape)
+    :return PaddedBitmask:
     """
-    best_size = fit_text_to_shape(text, fontfile, shape, kern_rate)
-    text_image = build_mask_from_text(text, fontfile, best_size, kern_rate)
-    bitmask = make_bitmask_from_bw_image(text_image)
-    bitmask = expand_bitmask_to_shape(bitmask, shape)
-    return bitmask
+    def rasterize():
+        best_size = fit_text_to_shape(text, fontfile, shape, kern_rate, cache=cache)
+        text_image = build_mask_from_text(text, fontfile, best_size, kern_rate)
+        bitmask = make_bitmask_from_bw_image(text_image)
+        return expand_bitmask_to_shape(bitmask, shape)
+
+    if not cache:
+        return rasterize()
+    key = get_bitmask_key(BitmaskMethod.STATIC_TEXT, text, fontfile, shape, kern_rate)
+    return get_cached_bitmask(key, rasterize)
+
+
+@instrument_stage()
+def build_bitmask_from_image(mask, shape):
+    """
+    Generate a bitmask from a black & white mask image file, resized to the given shape (w, h).
+        Bitmasks are cached in BITMASK_CACHE, so repeated calls skip rasterizing until the file is modified
+
+    :param str mask:            Path to the mask image
+    :param tuple(int) shape:
+    :return np.ndarray:
+    """
+    def rasterize():
+        with Image.open(mask) as mask_img:
+            return make_bitmask_from_bw_image(mask_img.convert('RGB').resize(tuple(shape)))
+
+    key = get_bitmask_key(BitmaskMethod.BITMASK_IMG, mask, None, shape, None, mtime=os.path.getmtime(mask))
+    return get_cached_bitmask(key, rasterize)
+
+
+def get_bitmask_key(method, text, fontfile, shape, kern_rate, mtime=None):
+    """
+    Normalize the parameters that define a bitmask into a hashable cache key
+
+    :param BitmaskMethod method:    How the bitmask is rasterized
+    :param str text:                Mask text, or the mask image path for BitmaskMethod.BITMASK_IMG
+    :param str fontfile:
+    :param tuple(int) shape:
+    :param float kern_rate:
+    :param float mtime:             Modification time of the mask image, for BitmaskMethod.BITMASK_IMG
+    :return tuple:
+    """
+    shape_w, shape_h = shape
+    kern_rate = float(kern_rate) if kern_rate is not None else None
+    return method, text, fontfile, (int(shape_w), int(shape_h)), kern_rate, mtime
+
+
+def get_cached_bitmask(key, rasterize):
+    """
+    Return the bitmask cached under key, calling rasterize() to build and cache it on a miss.
+        Every call returns a freshly unpacked array, so callers are free to modify it
+
+    :param tuple key:
+    :param function rasterize:  Takes no arguments, returns the bitmask as np.ndarray or PaddedBitmask
+    :return np.ndarray | PaddedBitmask:
+    """
+    packed_entry = BITMASK_CACHE.get(key)
+    if packed_entry is None:
+        bitmask = rasterize()
+        BITMASK_CACHE.put(key, pack_bitmask(bitmask))
+        return bitmask
+    return unpack_bitmask(packed_entry)
+
+
+def pack_bitmask(bitmask):
+    """
+    Pack a bool bitmask 8 pixels to the byte. Only the raster of a PaddedBitmask is packed
+    :param np.ndarray | PaddedBitmask bitmask:
+    :return tuple:     packed bits, original shape, and (offset, full_shape) for a PaddedBitmask else None
+    """
+    if isinstance(bitmask, PaddedBitmask):
+        raster = bitmask.raster
+        return np.packbits(raster, axis=None), raster.shape, (bitmask.offset, bitmask.full_shape)
+    return np.packbits(bitmask, axis=None), bitmask.shape, None
+
+
+def unpack_bitmask(packed_entry):
+    """
+    Inverse of pack_bitmask
+    :param tuple packed_entry:
+    :return np.ndarray | PaddedBitmask:
+    """
+    packed, shape, padding = packed_entry
+    bitmask = np.unpackbits(packed, count=math.prod(shape)).reshape(shape).view(bool)
+    return PaddedBitmask(bitmask, *padding) if padding else bitmask
 
 
-def simple_bitmask_swap(image1, image2, mask):
+@instrument_stage()
+def simple_bitmask_swap(image1, image2, mask, out=None, inplace=False):
     """
-    im1, im2, and mask all have to have the same dimensions
+    Swap the masked pixels of two images.
+        The first result shows image1 where the mask is set and image2 elsewhere; the second is its complement.
+        im1, im2, and mask all have to have the same height and width. The mask may be (h, w) or (h, w, 1).
+        Given a PaddedBitmask, the masked select only runs inside its bbox; outside it pixels are copied as is.
+        Not a single pass: each output is filled with a plain copy, then the masked pixels are overwritten,
+        so those are written twice. Writing every pixel once takes a masked copy for both the mask and
+        its complement, which measures slower than a contiguous copy plus one masked copy
+
     :param np.ndarray image1:
     :param np.ndarray image2:
-    :param np.ndarray mask:
+    :param np.ndarray | PaddedBitmask mask:
+    :param tuple(np.ndarray) out:   Optional pair of output buffers, shaped and typed like image1, to write into
+    :param bool inplace:            If True, swap the masked pixels between image1 and image2 directly
+                                        and return them. Only the masked pixels are touched.
     :return tuple(np.ndarray) :
     """
+    # Rows and columns of the images the mask covers; outside them, the mask is all False
+    region = (slice(None), slice(None))
+    if isinstance(mask, PaddedBitmask):
+        region, mask = mask.bbox, mask.raster
+    mask = np.asarray(mask)
+    mask_2d = mask[:, :, 0] if mask.ndim == 3 else mask
+
+    if inplace:
+        # Boolean indexing with a 2-D mask selects whole pixels either way, the pixel views are just faster
+        region_1, region_2 = image1[region], image2[region]
+        view_1, view_2 = get_pixel_view(region_1), get_pixel_view(region_2)
+        if view_1 is None or view_2 is None:
+            view_1, view_2 = region_1, region_2
+        held = view_1[mask_2d]
+        view_1[mask_2d] = view_2[mask_2d]
+        view_2[mask_2d] = held
+        return image2, image1
+
+    if out is None:
+        out = (np.empty_like(image1), np.empty_like(image2))
+    mask_is_img1, mask_is_img2 = out
 
-    mask_is_img1 = np.where(mask, image1, image2)
-    mask_is_img2 = np.where(mask, image2, image1)
+    # Seed each output with the opposite image, then copy the masked pixels over it (see docstring)
+    np.copyto(mask_is_img1, image2)
+    np.copyto(mask_is_img2, image1)
+
+    # Masked copies over whole pixels (see get_pixel_view) are much faster than broadcasting the mask over channels
+    arrs = tuple(arr[region] for arr in (image1, image2, mask_is_img1, mask_is_img2))
+    views = [get_pixel_view(arr) for arr in arrs]
+    if any(view is None for view in views):
+        views, mask_2d = arrs, mask_2d[:, :, np.newaxis]
+    view_1, view_2, out_view_1, out_view_2 = views
+    np.copyto(out_view_1, view_1, where=mask_2d)
+    np.copyto(out_view_2, view_2, where=mask_2d)
 
     return mask_is_img1, mask_is_img2
 
 
+def build_label_map(bitmasks):
+    """
+    Combine stamp bitmasks into one integer label map for stamp_swap_n_way().
+        Label 0 is the background, label i+1 marks stamp i. Where stamps overlap, the later stamp wins
+
+    :param list(np.ndarray) bitmasks:   Bitmasks of the same (h, w), each (h, w) or (h, w, 1)
+    :return np.ndarray:                 (h, w) label map
+    """
+    label_map = None
+    for label, bitmask in enumerate(bitmasks, start=1):
+        bitmask = np.asarray(bitmask)
+        bitmask = bitmask[:, :, 0] if bitmask.ndim == 3 else bitmask
+        if label_map is None:
+            label_map = np.zeros(bitmask.shape, dtype=np.min_scalar_type(len(bitmasks)))
+        label_map[bitmask] = label
+    return label_map
+
+
+def stamp_swap_n_way(sources, label_map):
+    """
+    Swap X stamps across N sources, the N-way version of simple_bitmask_swap.
+        Collage k takes each pixel from source (k + label) % N, so every source shows up in every region
+        across the N collages. All collages are built by a single gather over the stacked sources.
+
+    :param list(np.ndarray) | np.ndarray sources:   N sources of the same shape, or an (N, h, w, c) stack of them
+    :param np.ndarray label_map:                    (h, w) integer labels, e.g. from build_label_map()
+    :return np.ndarray:                             (N, h, w, c) stack of collages
+    """
+    stack = sources if isinstance(sources, np.ndarray) else np.stack(sources)
+    num_sources = stack.shape[0]
+    label_map = np.asarray(label_map)
+    label_map = label_map[:, :, 0] if label_map.ndim == 3 else label_map
+
+    # For every collage and pixel, the index of the source to sample from
+    index_dtype = np.min_scalar_type(num_sources + int(label_map.max()))
+    source_index = np.arange(num_sources, dtype=index_dtype)[:, np.newaxis, np.newaxis] + label_map
+    source_index %= num_sources
+
+    stack_view = get_pixel_view(stack) if stack.ndim == 4 else stack
+    if stack_view is None:
+        return np.take_along_axis(stack, source_index[..., np.newaxis], axis=0)
+    collages = np.take_along_axis(stack_view, source_index, axis=0)
+    return collages.view(stack.dtype).reshape(stack.shape)
+
+
 def make_bitmask_from_bw_image(mask_src):
     """
     Convert a 3-dimensional Image (mode-'RGB') into a 2-dimensional bitmask
@@ -110,37 +383,165 @@ def make_bitmask_from_bw_image(mask_src):
 
 def expand_bitmask_to_shape(bitmask, shape):
     """
-    If bitmask is lacking in some dimension, add rows/columns of False to fit shape
+    If bitmask is lacking in some dimension, center it in rows/columns of False to fit shape.
+        The padding isn't materialized: the result is a PaddedBitmask of the bitmask trimmed to its set pixels
     :param np.array bitmask:
     :param tuple(int) shape:
-    :return np.array:
+    :return PaddedBitmask:
     """
     w, h = shape
     # np.array.shape returns (height, width)
     w_diff = w - bitmask.shape[1]
     h_diff = h - bitmask.shape[0]
+    top, left = math.ceil(h_diff / 2), math.floor(w_diff / 2)
 
-    # use numpy to stack extra columns / rows around the bitmask
-    if w_diff:
-        curr_h = bitmask.shape[0]
-        left_add, right_add = math.floor(w_diff / 2), math.ceil(w_diff / 2)
-        left_stack = np.full((curr_h, left_add, 1), False)
-        right_stack = np.full((curr_h, right_add, 1), False)
-        bitmask = np.hstack((left_stack, bitmask, right_stack))
-
-    if h_diff:
-        curr_w = bitmask.shape[1]
-        top_add, bottom_add = math.ceil(h_diff / 2), math.floor(h_diff / 2)
-        top_stack = np.full((top_add, curr_w, 1), False)
-        bottom_stack = np.full((bottom_add, curr_w, 1), False)
-        bitmask = np.vstack((top_stack, bitmask, bottom_stack))
+    # Trim the whitespace around the glyphs too
+    rows = np.flatnonzero(bitmask.any(axis=(1, 2)))
+    cols = np.flatnonzero(bitmask.any(axis=(0, 2)))
+    if not len(rows):
+        return PaddedBitmask(bitmask[:0, :0], (0, 0), (h, w))
+    raster = bitmask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    return PaddedBitmask(raster, (top + rows[0], left + cols[0]), (h, w))
 
-    return bitmask
+
+def enable_fit_size_store(path=FIT_SIZE_STORE_PATH, compact=True):
+    """
+    Persist fit_text_to_shape() results to an append-only JSON-lines file so they survive restarts.
+        Entries already on disk are loaded into FIT_SIZE_CACHE; later misses are appended, never re-read.
+        Only results for static text are stored (see fit_text_to_shape)
+
+    :param str path:
+    :param bool compact:    Rewrite the store with only its latest FIT_SIZE_STORE_MAX_ENTRIES entries,
+                                if it has grown past that. Leave it to the main process,
+                                since appends by other processes during the rewrite are lost
+    :return:
+    """
+    global FIT_SIZE_STORE
+    FIT_SIZE_STORE = path
+    records, num_lines = read_fit_size_store()
+    if compact and num_lines > FIT_SIZE_STORE_MAX_ENTRIES:
+        records = dict(list(records.items())[-FIT_SIZE_STORE_MAX_ENTRIES:])
+        compact_fit_size_store(records)
+    for key, best_size in records.items():
+        FIT_SIZE_CACHE.put(key, best_size)
+
+
+def disable_fit_size_store():
+    global FIT_SIZE_STORE
+    FIT_SIZE_STORE = None
+
+
+def get_fit_size_store():
+    """
+    :return str:    Path of the on-disk fit-size store, None if disabled
+    """
+    return FIT_SIZE_STORE
+
+
+def get_fit_size_key(text, fontfile, shape, kern_rate):
+    """
+    Normalize the parameters of fit_text_to_shape() into a hashable cache key
+    :return tuple:
+    """
+    shape_w, shape_h = shape
+    return text, fontfile, (int(shape_w), int(shape_h)), float(kern_rate)
+
+
+def read_fit_size_store():
+    """
+    Read the on-disk fit-size store. Unparseable lines (e.g. one cut short by a crash) are skipped
+    :return (dict, int): {cache_key: best_size}, oldest first, and the number of lines in the store
+    """
+    records = {}
+    num_lines = 0
+    if not (FIT_SIZE_STORE and os.path.isfile(FIT_SIZE_STORE)):
+        return records, num_lines
+    try:
+        with open(FIT_SIZE_STORE) as f:
+            for num_lines, line in enumerate(f, start=1):
+                try:
+                    text, fontfile, shape, kern_rate, best_size = json.loads(line)
+                except (TypeError, ValueError):
+                    continue
+                key = get_fit_size_key(text, fontfile, shape, kern_rate)
+                records.pop(key, None)  # Keep the latest entry, in order of appearance
+                records[key] = best_size
+    except OSError:
+        logger.warning(f"Ignoring unreadable fit-size store {FIT_SIZE_STORE}")
+    return records, num_lines
+
+
+def format_fit_size_record(key, best_size):
+    return json.dumps([*key, best_size]) + '\n'
+
+
+def write_fit_size_store(key, best_size):
+    """
+    Append one entry to the on-disk fit-size store.
+        Each entry goes out in a single O_APPEND write, so concurrent processes never interleave
+        or lose each other's entries
+
+    :param tuple key:
+    :param int best_size:
+    :return:
+    """
+    with FIT_SIZE_STORE_LOCK:
+        os.makedirs(os.path.dirname(FIT_SIZE_STORE), exist_ok=True)
+        fd = os.open(FIT_SIZE_STORE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, format_fit_size_record(key, best_size).encode())
+        finally:
+            os.close(fd)
 
 
-def fit_text_to_shape(text, fontfile, shape, kern_rate):
+def compact_fit_size_store(records):
     """
-    Determine maximum fonsize for text in a bitmask of specified shape
+    Replace the on-disk fit-size store with records, through a temp file so readers never see a partial write
+    :param dict records: {cache_key: best_size}
+    :return:
+    """
+    with FIT_SIZE_STORE_LOCK:
+        tmp_path = f"{FIT_SIZE_STORE}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.writelines(format_fit_size_record(key, best_size) for key, best_size in records.items())
+        os.replace(tmp_path, FIT_SIZE_STORE)
+
+
+def fit_text_to_shape(text, fontfile, shape, kern_rate, cache=True):
+    """
+    Determine maximum fonsize for text in a bitmask of specified shape.
+        Results are memoized in FIT_SIZE_CACHE, and in the on-disk store if enabled
+
+    :param str text:
+    :param str fontfile:
+    :param tuple(int) shape:
+    :param float kern_rate:
+    :param bool cache:          False for one-off text (e.g. random text), which would only crowd out
+                                    entries that get reused
+    :return int:                The font_size to get the text_mask closest to shape without exceeding
+    """
+    if not cache:
+        return search_text_fit_size(text, fontfile, shape, kern_rate)
+
+    key = get_fit_size_key(text, fontfile, shape, kern_rate)
+    best_size = FIT_SIZE_CACHE.get(key)
+    if best_size is not None:
+        return best_size
+
+    # The store was loaded into FIT_SIZE_CACHE when enabled, so a miss is searched for, not looked up on disk
+    best_size = search_text_fit_size(text, fontfile, shape, kern_rate)
+    if FIT_SIZE_STORE:
+        write_fit_size_store(key, best_size)
+    FIT_SIZE_CACHE.put(key, best_size)
+    return best_size
+
+
+def search_text_fit_size(text, fontfile, shape, kern_rate):
+    """
+    Search for the maximum fontsize for text in a bitmask of specified shape.
+        Text dimensions come from font metrics (see measure_text_box), so nothing is rendered;
+        the fontsize is found by bracketing an initial estimate then bisecting
+
     :param str text:
     :param str fontfile:
     :param tuple(int) shape:
@@ -148,31 +549,29 @@ def fit_text_to_shape(text, fontfile, shape, kern_rate):
     :return int:                The font_size to get the text_mask closest to shape without exceeding
     """
     shape_w, shape_h = shape
-    # TODO (later) OPTIMIZATION compute the initial font size as some rough estimate function based on the image shape and font properties
-    best_size = 50
-    text_image = build_mask_from_text(text, fontfile, best_size, kern_rate)
-    text_w, text_h = text_image.size
-
-    # Get text_image as large as possible using fontfile
-    while (text_w < shape_w) and (text_h < shape_h):
-        WL = (shape_w - text_w) / (shape_h - text_h)
-        WGR = (text_w / text_h)
-        if WGR >= WL:
-            # text_image will bump into source sides as it continues to grow
-            size_rate = shape_w / text_w
-        else:
-            # text_image will bump into top/bottom as it continues to grow
-            size_rate = shape_h / text_h
 
-        # math.ceil() might push the font size slighty above optimal
-        best_size = math.ceil(size_rate * best_size)
-        text_image = build_mask_from_text(text, fontfile, best_size, kern_rate)
-        text_w, text_h = text_image.size
+    def measure(fontsize):
+        return measure_text_box(text, get_font(fontfile, fontsize), kern_rate)
 
-    # Reduce fontsize gradually until we are in bounds of the source images
-    while (text_w > shape_w) or (text_h > shape_h):
-        best_size -= 1
-        text_image = build_mask_from_text(text, fontfile, best_size, kern_rate)
-        text_w, text_h = text_image.size
+    def fits(fontsize):
+        text_w, text_h = measure(fontsize)
+        return text_w <= shape_w and text_h <= shape_h
 
-    return best_size
+    # Text dimensions scale roughly linearly with fontsize, so a single measurement gives a close estimate
+    probe_size = 50
+    probe_w, probe_h = measure(probe_size)
+    estimate = max(1, math.floor(probe_size * min(shape_w / probe_w, shape_h / probe_h)))
+
+    # Bracket the answer: lo_size always fits (or is the minimum size), hi_size never does
+    lo_size, hi_size = 1, estimate
+    while fits(hi_size):
+        lo_size, hi_size = hi_size, hi_size * 2
+
+    while hi_size - lo_size > 1:
+        mid_size = (lo_size + hi_size) // 2
+        if fits(mid_size):
+            lo_size = mid_size
+        else:
+            hi_size = mid_size
+
+    return lo_size
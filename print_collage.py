@@ -0,0 +1,40 @@
+"""
+Render a collage pair at print resolution, tile by tile, so the print never has to fit in RAM.
+    The collages are written as memory-mapped .npy files in ./output, and optionally as tiled TIFFs (needs tifffile).
+    Source transforms are not applied at print size; the sources are only cropped centrally to the print's aspect ratio
+
+Usage:
+    python print_collage.py --spec-srcs 17,42 --text LOVE --print-w 24000 --print-h 36000 --tiff
+"""
+from main import *
+
+PRINT_W = 12000
+PRINT_H = 18000
+EXPORT_TIFF = False
+
+
+def render_print(spec_srcs:list=SPEC_SRCS,
+                 text:str=TEXT,
+                 print_w:int=PRINT_W,
+                 print_h:int=PRINT_H,
+                 tile_size:int=PRINT_TILE_SIZE,
+                 kern_rate:float=KERN_RATE,
+                 tiff:bool=EXPORT_TIFF,
+                 ):
+    filenames = get_specific_sources(spec_srcs)[:2]
+    if len(filenames) < 2:
+        filenames.extend(get_source_files()[-(2 - len(filenames)):])
+    logger.info(f"Printing {filenames} at {print_w}x{print_h}")
+
+    random_id = uuid.uuid4().__str__().split('-')[0]
+    out_paths = [f'./output/{random_id}_print_{i}.npy' for i in range(2)]
+    render_tiled_collages(filenames, text, (print_w, print_h), out_paths, tile_size=tile_size, kern_rate=kern_rate)
+    if tiff:
+        out_paths = [export_tiled_tiff(path, path.replace('.npy', '.tif')) for path in out_paths]
+    logger.info(f"Saved {out_paths}")
+    return out_paths
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s')
+    fn_cli(render_print, prepare=setup)
@@ -0,0 +1,318 @@
+"""
+Long-running local render service, e.g. for the "(Your Text Here)" exhibit.
+    Fonts, fitted text sizes, decoded sources and bitmasks stay warm in memory between requests.
+    Renders run on a pool of threads behind a bounded queue; when the queue is full, requests
+    are turned away with 503 rather than piling up.
+
+Endpoints:
+    POST /render    JSON body (see parse_render_request). Responds with the collage as image/jpeg,
+                        and the seed that replays it in the X-Render-Seed header
+    GET  /stats     JSON: request counts and latencies, queue depth, cache hit rates, buffer pool reuse
+
+Usage:
+    python service.py --port 8008 --threads 4 --queue 16 --warm 50
+    python loadgen.py --clients 8 --requests 200    # Measure latency under concurrent load
+"""
+import sys
+import json
+import time
+import random
+import argparse
+from collections import Counter, deque
+from concurrent.futures import TimeoutError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from main import *
+
+HOST = '127.0.0.1'
+PORT = 8008
+RENDER_THREADS = 4
+MAX_QUEUED = 16  # Requests waiting for a render thread, beyond those being rendered
+REQUEST_TIMEOUT_S = 60
+MAX_TEXT_LEN = 24
+MAX_BODY_BYTES = 64 * 1024
+WARM_SOURCES = 0  # Number of the latest sources to decode at startup
+LATENCY_WINDOW = 1000  # Number of recent requests that /stats latencies are computed over
+# Mask images are files on this machine, so BITMASK_IMG is not offered to clients
+SERVED_BITMASK_METHODS = [BitmaskMethod.STATIC_TEXT, BitmaskMethod.RANDOM_TEXT]
+
+
+def get_request_field(body, name, types, default):
+    """
+    Return body[name] (default if absent), checking it is one of the JSON types given.
+        JSON true/false are never taken for numbers
+
+    :param dict body:
+    :param str name:
+    :param tuple(type) types:
+    :param default:
+    :return:
+    """
+    value = body.get(name, default)
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        type_names = ('null' if t is type(None) else t.__name__ for t in types)
+        raise ValueError(f"{name} must be of type {' or '.join(type_names)}")
+    return value
+
+
+def parse_render_request(body, target_size=TARGET_SIZE, time_budget_ms=TIME_BUDGET_MS):
+    """
+    Validate a /render request body. Every field is optional:
+        text (str), bitmask_method (STATIC_TEXT | RANDOM_TEXT), sources (up to 2 source names, without '.jpg'),
+        kern_rate (float), use_latest (bool), draw_handle (bool), collage ('A' | 'B'), seed (int)
+
+    :param dict body:
+    :param int target_size:     See main.TARGET_SIZE
+    :param int time_budget_ms:  See main.TIME_BUDGET_MS
+    :return (dict, dict):       Arguments for render_collages(), and the options for encoding the result
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Request body must be a JSON object")
+
+    text = get_request_field(body, 'text', (str,), TEXT)
+    if not (0 < len(text) <= MAX_TEXT_LEN):
+        raise ValueError(f"text must be 1 to {MAX_TEXT_LEN} characters")
+
+    try:
+        bitmask_method = parse_enum_option(BitmaskMethod,
+                                           get_request_field(body, 'bitmask_method', (str,), BITMASK_METHOD.name))
+    except argparse.ArgumentTypeError as e:
+        raise ValueError(f"bitmask_method: {e}")
+    if bitmask_method not in SERVED_BITMASK_METHODS:
+        raise ValueError(f"bitmask_method must be one of {', '.join(m.name for m in SERVED_BITMASK_METHODS)}")
+
+    sources = body.get('sources', [])
+    if not isinstance(sources, list) or len(sources) > 2 or not all(isinstance(name, str) for name in sources):
+        raise ValueError("sources must be a list of at most 2 source names")
+    missing = [name for name in sources if f'{name}.jpg' not in SOURCE_MANIFEST]
+    if missing:
+        raise ValueError(f"Unknown sources: {', '.join(missing)}")
+
+    kern_rate = get_request_field(body, 'kern_rate', (int, float), KERN_RATE)
+    if not (0.1 <= kern_rate <= 3.0):  # Checked before float(), which overflows on huge JSON integers
+        raise ValueError("kern_rate must be between 0.1 and 3.0")
+    kern_rate = float(kern_rate)
+
+    collage = body.get('collage', 'A')
+    if collage not in ('A', 'B'):
+        raise ValueError("collage must be 'A' or 'B'")
+
+    seed = get_request_field(body, 'seed', (int, type(None)), None)
+    seed = seed if seed is not None else random.getrandbits(64)
+
+    use_latest = get_request_field(body, 'use_latest', (bool,), False)
+    draw_handle = get_request_field(body, 'draw_handle', (bool,), DRAW_HANDLE)
+
+    render_kwargs = dict(mask=MASK, text=text, bitmask_method=bitmask_method, use_latest=use_latest,
+                         kern_rate=kern_rate, spec_srcs=sources, target_size=target_size,
+                         time_budget_ms=time_budget_ms or None)
+    options = dict(collage=collage, draw_handle=draw_handle, seed=seed)
+    return render_kwargs, options
+
+
+class RenderService:
+    """
+    Renders collages on a pool of threads, sharing this process's caches.
+        At most num_threads + max_queued renders are accepted at a time; submit() refuses the rest
+    """
+    def __init__(self, num_threads=RENDER_THREADS, max_queued=MAX_QUEUED):
+        self._pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='Render')
+        self._slots = threading.BoundedSemaphore(num_threads + max_queued)
+        self._lock = threading.Lock()
+        self.num_threads = num_threads
+        self.max_queued = max_queued
+        self.in_flight = 0
+        self.status_counts = Counter()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # Seconds taken by recent successful requests
+        self.started = time.time()
+
+    def submit(self, render_kwargs, options):
+        """
+        :param dict render_kwargs:
+        :param dict options:
+        :return Future:     Resolves to the JPEG bytes, or None if the queue is full
+        """
+        if not self._slots.acquire(blocking=False):
+            return None
+        with self._lock:
+            self.in_flight += 1
+        future = self._pool.submit(self.render, render_kwargs, options)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    @staticmethod
+    def render(render_kwargs, options):
+        rng = random.Random(options['seed'])
+        collages = render_collages(rng=rng, **render_kwargs)
+        collage = collages[0 if options['collage'] == 'A' else 1]
+        jpeg_bytes = encode_image_from_array(collage, options['draw_handle'], rng=rng)
+        BUFFER_POOL.give(*collages)
+        return jpeg_bytes
+
+    def record(self, status, seconds):
+        with self._lock:
+            self.status_counts[status] += 1
+            if status == 200:
+                self.latencies.append(seconds)
+
+    def stats(self):
+        """
+        :return dict:
+        """
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000
+            stats = {
+                'uptime_s': time.time() - self.started,
+                'threads': self.num_threads,
+                'max_queued': self.max_queued,
+                'in_flight': self.in_flight,
+                'responses': {str(status): count for status, count in self.status_counts.items()},
+            }
+        if len(latencies):
+            stats['latency_ms'] = {f'p{p}': float(np.percentile(latencies, p)) for p in (50, 95, 99)}
+            stats['latency_ms']['max'] = float(latencies.max())
+        stats['caches'] = {name: {'hits': cache.hits, 'misses': cache.misses, 'entries': len(cache)}
+                           for name, cache in (('sources', SOURCE_CACHE), ('bitmasks', BITMASK_CACHE),
+                                               ('fit_sizes', FIT_SIZE_CACHE), ('fonts', FONT_POOL))}
+        stats['buffer_pool'] = BUFFER_POOL.stats()
+        return stats
+
+    def close(self):
+        self._pool.shutdown()
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    service = None  # The RenderService, set by serve()
+    parse_kwargs = {}  # Passed to parse_render_request, set by serve()
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.service.stats())
+        else:
+            self.send_json(404, {'error': f"No such endpoint {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/render':
+            self.send_json(404, {'error': f"No such endpoint {self.path}"})
+            return
+
+        start = time.perf_counter()
+        status = 500
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError("Invalid Content-Length")
+            if length > MAX_BODY_BYTES:
+                raise ValueError("Request body too large")
+            body = json.loads(self.rfile.read(length) or b'{}')
+            render_kwargs, options = parse_render_request(body, **self.parse_kwargs)
+        except (TypeError, ValueError) as e:  # Includes json.JSONDecodeError
+            status = 400
+            self.send_json(status, {'error': str(e)})
+            self.service.record(status, time.perf_counter() - start)
+            return
+
+        future = self.service.submit(render_kwargs, options)
+        if future is None:
+            status = 503
+            self.send_json(status, {'error': "Render queue is full, try again shortly"}, {'Retry-After': '1'})
+        else:
+            jpeg_bytes = None
+            try:
+                jpeg_bytes = future.result(timeout=REQUEST_TIMEOUT_S)
+            except TimeoutError:
+                status = 504
+                self.send_json(status, {'error': f"Render took longer than {REQUEST_TIMEOUT_S}s"})
+            except Exception as e:
+                logger.exception(f"Render failed: {render_kwargs}, {options}")
+                self.send_json(status, {'error': f"Render failed: {e}"})
+            if jpeg_bytes is not None:
+                status = 200
+                self.send_response(status)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(jpeg_bytes)))
+                self.send_header('X-Render-Seed', str(options['seed']))
+                self.end_headers()
+                self.wfile.write(jpeg_bytes)
+        self.service.record(status, time.perf_counter() - start)
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def warm_sources(n=WARM_SOURCES, target_size=TARGET_SIZE):
+    """
+    Decode the latest <n> sources into SOURCE_CACHE, so the first requests don't pay for it
+
+    :param int n:
+    :param int target_size:
+    :return:
+    """
+    source_files = get_source_files()
+    for filename in source_files[-n:] if n else []:
+        decode_source(filename, target_size=target_size or None)
+    logger.info(f"Warmed {min(n, len(source_files))} sources")
+
+
+def serve(host=HOST, port=PORT, num_threads=RENDER_THREADS, max_queued=MAX_QUEUED, target_size=TARGET_SIZE,
+          time_budget_ms=TIME_BUDGET_MS):
+    """
+    Run the service until interrupted
+
+    :param str host:
+    :param int port:
+    :param int num_threads:
+    :param int max_queued:
+    :param int target_size:
+    :param int time_budget_ms:
+    :return:
+    """
+    service = RenderService(num_threads, max_queued)
+    RenderRequestHandler.service = service
+    RenderRequestHandler.parse_kwargs = dict(target_size=target_size, time_budget_ms=time_budget_ms)
+    server = ThreadingHTTPServer((host, port), RenderRequestHandler)
+    server.daemon_threads = True
+    logger.info(f"Rendering on http://{host}:{port} with {num_threads} threads, up to {max_queued} queued")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--threads', type=int, default=RENDER_THREADS)
+    parser.add_argument('--queue', type=int, default=MAX_QUEUED, help='Requests allowed to wait for a thread')
+    parser.add_argument('--warm', type=int, default=WARM_SOURCES, help='Decode the latest N sources at startup')
+    parser.add_argument('--target-size', type=int, default=TARGET_SIZE, help='See main.TARGET_SIZE')
+    parser.add_argument('--time-budget-ms', type=int, default=TIME_BUDGET_MS, help='See main.TIME_BUDGET_MS')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(message)s')
+    setup()
+    warm_sources(args.warm, args.target_size)
+    serve(args.host, args.port, args.threads, args.queue, args.target_size, args.time_budget_ms)
+
+
+if __name__ == '__main__':
+    cli()
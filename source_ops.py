@@ -15,6 +15,11 @@ COST_LEVEL_3 = 30
 COST_LEVEL_4 = 50
 COST_LEVEL_5 = 80
 
+# Measured cost of each transform on this machine, keyed by transform name (see calibrate_transform_costs in bench.py).
+#   Filled in place by load_transform_cost_model(), so modules that star-import it see the update
+TRANSFORM_COST_MODEL = {}
+TRANSFORM_COST_MODEL_PATH = os.path.join(CACHE_DIR, 'transform_costs.json')
+
 
 def apply_transform_cost(cost=COST_LEVEL_3):
     """
@@ -32,7 +37,37 @@ def apply_transform_cost(cost=COST_LEVEL_3):
     return wrapper
 
 
+def apply_index_remap(remap):
+    """
+    Decorator method to attach the coordinate-remap form of a source transform as a "index_remap" attribute.
+        chaos_source_transform composes these remaps (see tools.IndexRemap) instead of running
+        the transforms one at a time
+
+    :param function remap:  Takes (rows, cols, **kwargs) and returns the remapped (rows, cols),
+                            drawing any random choices exactly as the transform itself does
+    :return:
+    """
+    def wrapper(fn):
+        fn.index_remap = remap
+        return fn
+    return wrapper
+
+
+def remap_flip_lr(rows, cols, rng=None):
+    return rows, cols[::-1]
+
+
+def remap_flip_ud(rows, cols, rng=None):
+    return rows[::-1], cols
+
+
+def remap_rotate_180(rows, cols, rng=None):
+    return rows[::-1], cols[::-1]
+
+
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_1)
+@apply_index_remap(remap_flip_lr)
 def source_flip_lr(im_arr):
     """
     Flip L-R an image array
@@ -43,7 +78,9 @@ def source_flip_lr(im_arr):
     return np.fliplr(im_arr)
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_1)
+@apply_index_remap(remap_flip_ud)
 def source_flip_ud(im_arr):
     """
     Flip U-D an image array
@@ -54,7 +91,9 @@ def source_flip_ud(im_arr):
     return np.flipud(im_arr)
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_1)
+@apply_index_remap(remap_rotate_180)
 def source_rotate_180(im_arr):
     """
     Rotate 180 degrees an image array
@@ -65,151 +104,272 @@ def source_rotate_180(im_arr):
     return np.rot90(m=im_arr, k=2)
 
 
+def remap_crop_random(rows, cols, rng=None):
+    rng = get_rng(rng)
+    cropbox_method = rng.choice(CROPBOX_OPERATIONS)
+    left, top, right, bottom = cropbox_method(make_shape_proxy(len(rows), len(cols)), rng=rng)
+    return rows[top:bottom], cols[left:right]
+
+
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_1)
-def source_crop_random(im_arr):
+@apply_index_remap(remap_crop_random)
+def source_crop_random(im_arr, rng=None):
     """
     Apply cropping to image array with a randomly-selected method
 
     :param np.ndarray im_arr:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    cropbox_method = random.choice(CROPBOX_OPERATIONS)
-    cropped_im_arr = crop_im_arr(im_arr=im_arr, cropbox_method=cropbox_method)
+    rng = get_rng(rng)
+    cropbox_method = rng.choice(CROPBOX_OPERATIONS)
+    cropped_im_arr = crop_im_arr(im_arr=im_arr, cropbox_method=cropbox_method, rng=rng)
     return cropped_im_arr
 
 
+def remap_phase_vert(rows, cols, shift=None, rng=None):
+    rng = get_rng(rng)
+    if shift is None:
+        shift = math.floor(rng.random() * len(rows))
+    return np.roll(rows, shift), cols
+
+
+def remap_phase_hor(rows, cols, shift=None, rng=None):
+    rng = get_rng(rng)
+    if shift is None:
+        shift = math.floor(rng.random() * len(cols))
+    return rows, np.roll(cols, shift)
+
+
+def remap_phase_complete(rows, cols, rng=None):
+    rows, cols = remap_phase_hor(rows, cols, rng=rng)
+    return remap_phase_vert(rows, cols, rng=rng)
+
+
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_2)
-def source_phase_vert(im_arr, shift=None):
+@apply_index_remap(remap_phase_vert)
+def source_phase_vert(im_arr, shift=None, rng=None):
     """
     Phase (np.roll) an image according along its vertical axis
 
     :param im_arr:
     :param int shift:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return:
     """
+    rng = get_rng(rng)
     if shift is None:
         # shape == (w, h)
         shape = get_np_array_shape(im_arr)
-        shift = math.floor(random.random() * shape[1])
+        shift = math.floor(rng.random() * shape[1])
 
     return np.roll(im_arr, axis=0, shift=shift)
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_2)
-def source_phase_hor(im_arr, shift=None):
+@apply_index_remap(remap_phase_hor)
+def source_phase_hor(im_arr, shift=None, rng=None):
     """
     Phase ('roll') an image according along its horizontal axis
 
     :param im_arr:
     :param int shift:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return:
     """
+    rng = get_rng(rng)
     if shift is None:
         # shape == (w, h)
         shape = get_np_array_shape(im_arr)
-        shift = math.floor(random.random() * shape[0])
+        shift = math.floor(rng.random() * shape[0])
 
     return np.roll(im_arr, axis=1, shift=shift)
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_2)
-def source_phase_complete(im_arr):
+@apply_index_remap(remap_phase_complete)
+def source_phase_complete(im_arr, rng=None):
     """
     Phase ('roll') an image according to both width and height axes
 
     :param np.ndarray im_arr:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return:
     """
-    im_arr = source_phase_hor(im_arr)
-    im_arr = source_phase_vert(im_arr)
+    im_arr = source_phase_hor(im_arr, rng=rng)
+    im_arr = source_phase_vert(im_arr, rng=rng)
 
     return im_arr
 
 
+def remap_resample_shuffle(rows, cols, num_slices=None, rng=None):
+    rng = get_rng(rng)
+    num_slices = num_slices if num_slices else 2 ** rng.choice(range(1, 6))
+
+    order = list(range(num_slices))
+    rng.shuffle(order)
+    return rows, cols[build_slice_order_index(len(cols), num_slices, order)]
+
+
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_3)
-def source_resample_shuffle(im_arr, num_slices=None):
+@apply_index_remap(remap_resample_shuffle)
+def source_resample_shuffle(im_arr, num_slices=None, rng=None):
     """
     Vertically slice up image and rearrange the slices randomly
         Return image as np.ndarray
 
     :param np.ndarray im_arr:
     :param int num_slices:      Number of slices to generate
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    num_slices = num_slices if num_slices else 2 ** random.choice(range(1, 6))
+    return IndexRemap(im_arr).apply(remap_resample_shuffle, rng=rng, num_slices=num_slices).materialize()
+
+
+def remap_resample_reverse(rows, cols, num_slices=None, rng=None):
+    rng = get_rng(rng)
+    num_slices = num_slices if num_slices else 2 ** rng.choice(range(1, 6))
 
-    slices = slice_up_array_uniform(im_arr, num_slices)
-    random.shuffle(slices)
-    return np.hstack(slices)
+    order = tuple(range(num_slices))[::-1]
+    return rows, cols[get_slice_order_index(len(cols), num_slices, order)]
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_3)
-def source_resample_reverse(im_arr, num_slices=None):
+@apply_index_remap(remap_resample_reverse)
+def source_resample_reverse(im_arr, num_slices=None, rng=None):
     """
     Vertically slice up image and reverse the order
 
     :param np.ndarray im_arr:
     :param int num_slices:               Number of slices to generate
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    num_slices = num_slices if num_slices else 2 ** random.choice(range(1, 6))
-
-    slices = slice_up_array_uniform(im_arr, num_slices)
-    slices = slices[::-1]
-    return np.hstack(slices)
+    return IndexRemap(im_arr).apply(remap_resample_reverse, rng=rng, num_slices=num_slices).materialize()
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_4)
-def source_resample_flip_slices_vert(im_arr, num_slices=None, axis=None):
+def source_resample_flip_slices_vert(im_arr, num_slices=None, axis=None, rng=None):
     """
     Take an image array, slice it up vertically, and np.flip alternating slices
 
     :param np.ndarray im_arr:
     :param num_slices:
     :param axis:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray :
     """
-    num_slices = num_slices if num_slices else random.choice(range(2, 40))
-    slices = slice_up_array_uniform(im_arr, num_slices=num_slices)
-    axis = axis if isinstance(axis, int) else random.choice([0, 1])  # Flip slices UD or LR
-    slices = list(map(lambda tup: tup[1] if tup[0] % 2 == 0 else np.flip(tup[1], axis=axis), enumerate(slices)))
-    return np.hstack(slices)
+    rng = get_rng(rng)
+    num_slices = num_slices if num_slices else rng.choice(range(2, 40))
+    axis = axis if isinstance(axis, int) else rng.choice([0, 1])  # Flip slices UD or LR
+    return flip_alternate_slices(im_arr, num_slices, flip_axis=axis, slice_axis=1)
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_4)
-def source_resample_flip_slices_hor(im_arr, num_slices=None, axis=None):
+def source_resample_flip_slices_hor(im_arr, num_slices=None, axis=None, rng=None):
     """
     Take an image array, slice it up horizontally, and np.flip alternating slices
 
     :param np.ndarray im_arr:
     :param num_slices:
     :param axis:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    im_arr = np.rot90(im_arr, k=1)
-    im_arr = source_resample_flip_slices_vert(im_arr, num_slices, axis)
-    im_arr = np.rot90(im_arr, k=3)
-    return im_arr
+    rng = get_rng(rng)
+    num_slices = num_slices if num_slices else rng.choice(range(2, 40))
+    axis = axis if isinstance(axis, int) else rng.choice([0, 1])  # Flip slices LR or UD
+    # axis is given as if the image were rotated 90 degrees, like the vertical version being run on its side
+    return flip_alternate_slices(im_arr, num_slices, flip_axis=(1 - axis), slice_axis=0)
 
 
-def get_num_slices_per_dup_vert(num_dups, portrait_mode):
+def flip_alternate_slices(im_arr, num_slices, flip_axis, slice_axis):
+    """
+    Slice up an image array into uniform strips and np.flip the odd-numbered strips
+
+    :param np.ndarray im_arr:
+    :param int num_slices:
+    :param int flip_axis:       Axis along which each odd strip is flipped
+    :param int slice_axis:      1 for vertical strips, 0 for horizontal strips
+    :return np.ndarray:
+    """
+    length = im_arr.shape[slice_axis]
+    if flip_axis == slice_axis:
+        # Flipping strips along the slicing axis only reorders columns (or rows)
+        index = get_slice_order_index(length, num_slices, tuple(range(num_slices)), flip_odd=True)
+        return take_columns(im_arr, index) if slice_axis == 1 else take_rows(im_arr, index)
+
+    odd_bounds = get_slice_bounds(length, num_slices)[1::2]
+    flipped_im_arr = np.array(im_arr)
+    flipped_view = np.swapaxes(flipped_im_arr, 0, 1) if slice_axis == 0 else flipped_im_arr
+    src_view = np.swapaxes(im_arr, 0, 1) if slice_axis == 0 else im_arr
+    for start, stop in odd_bounds:
+        flipped_view[:, start:stop] = src_view[::-1, start:stop]
+    return flipped_im_arr
+
+
+def roll_slices(im_arr, shifts, slice_axis):
+    """
+    Slice up an image array into uniform strips and np.roll each strip along the other axis by its own shift.
+        Strips are rolled straight into a single output array rather than rolled and stacked
+
+    :param np.ndarray im_arr:
+    :param list(int) shifts:    One shift per strip
+    :param int slice_axis:      1 for vertical strips, 0 for horizontal strips
+    :return np.ndarray:
+    """
+    rolled_im_arr = np.empty_like(im_arr)
+    # Work on vertical strips either way, by swapping axes for horizontal ones
+    rolled_view = np.swapaxes(rolled_im_arr, 0, 1) if slice_axis == 0 else rolled_im_arr
+    src_view = np.swapaxes(im_arr, 0, 1) if slice_axis == 0 else im_arr
+
+    length = src_view.shape[0]
+    for (start, stop), shift in zip(get_slice_bounds(src_view.shape[1], len(shifts)), shifts):
+        shift %= length
+        rolled_view[shift:, start:stop] = src_view[:(length - shift), start:stop]
+        rolled_view[:shift, start:stop] = src_view[(length - shift):, start:stop]
+    return rolled_im_arr
+
+
+def get_num_slices_per_dup_vert(num_dups, portrait_mode, rng=None):
     """
 
     :param int num_dups:
     :param bool portrait_mode:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return:
     """
+    rng = get_rng(rng)
     if not portrait_mode or num_dups <= 4:
-        exp = random.choice(range(1, 6))
+        exp = rng.choice(range(1, 6))
     elif num_dups == 5:
-        exp = random.choice([1, 2, 3, 5])
+        exp = rng.choice([1, 2, 3, 5])
     else:
         exp = 5
     return 2 ** exp
 
 
+def remap_resample_stack_vertical(rows, cols, num_dups=None, num_slices_per_dup=None, portrait_mode=False, rng=None):
+    rng = get_rng(rng)
+    num_dups = num_dups if num_dups else rng.choice(range(2,8))
+    num_slices_per_dup = num_slices_per_dup if num_slices_per_dup else get_num_slices_per_dup_vert(num_dups, portrait_mode, rng)
+
+    num_slices = num_dups * num_slices_per_dup
+    return rows, cols[get_resample_index(len(cols), num_slices, num_dups)]
+
+
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_4)
-def source_resample_stack_vertical(im_arr, num_dups=None, num_slices_per_dup=None, portrait_mode=False):
+@apply_index_remap(remap_resample_stack_vertical)
+def source_resample_stack_vertical(im_arr, num_dups=None, num_slices_per_dup=None, portrait_mode=False, rng=None):
     """
     Reorder vertical slices of an image into a stack of duplicates via uniform sampling
         Perfect for making creepy thin duplications of faces
@@ -218,18 +378,26 @@ def source_resample_stack_vertical(im_arr, num_dups=None, num_slices_per_dup=Non
     :param num_dups:
     :param num_slices_per_dup:
     :param bool portrait_mode:  Whether the source is a face portrait
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    num_dups = num_dups if num_dups else random.choice(range(2,8))
-    num_slices_per_dup = num_slices_per_dup if num_slices_per_dup else get_num_slices_per_dup_vert(num_dups, portrait_mode)
+    return IndexRemap(im_arr).apply(remap_resample_stack_vertical, rng=rng, num_dups=num_dups,
+                                    num_slices_per_dup=num_slices_per_dup, portrait_mode=portrait_mode).materialize()
+
+
+def remap_resample_stack_horizontal(rows, cols, num_dups=None, num_slices_per_dup=None, portrait_mode=False, rng=None):
+    rng = get_rng(rng)
+    num_dups = num_dups if num_dups else rng.choice(range(2,5))
+    num_slices_per_dup = num_slices_per_dup if num_slices_per_dup else 2 ** rng.choice(range(4, 7))
 
     num_slices = num_dups * num_slices_per_dup
-    duped_im_arr = slice_resample_array_vertical(im_arr, num_dups, num_slices)
-    return duped_im_arr
+    return rows[get_resample_index(len(rows), num_slices, num_dups)], cols
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_4)
-def source_resample_stack_horizontal(im_arr, num_dups=None, num_slices_per_dup=None, portrait_mode=False):
+@apply_index_remap(remap_resample_stack_horizontal)
+def source_resample_stack_horizontal(im_arr, num_dups=None, num_slices_per_dup=None, portrait_mode=False, rng=None):
     """
     Reorder horizontal slices of an image into a stack of duplicates of the original,
         via uniform sampling
@@ -238,58 +406,83 @@ def source_resample_stack_horizontal(im_arr, num_dups=None, num_slices_per_dup=N
     :param num_dups:
     :param num_slices_per_dup:
     :param bool portrait_mode:  Whether the source is a face portrait
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    num_dups = num_dups if num_dups else random.choice(range(2,5))
-    num_slices_per_dup = num_slices_per_dup if num_slices_per_dup else 2 ** random.choice(range(4, 7))
-
-    num_slices = num_dups * num_slices_per_dup
-    rotated_im_arr = np.rot90(m=im_arr, k=1)    # 90
-    duped_rotated_im_arr = slice_resample_array_vertical(rotated_im_arr, num_dups, num_slices)
-    final_im_arr = np.rot90(m=duped_rotated_im_arr, k=3)    # 270
-    return final_im_arr
+    return IndexRemap(im_arr).apply(remap_resample_stack_horizontal, rng=rng, num_dups=num_dups,
+                                    num_slices_per_dup=num_slices_per_dup, portrait_mode=portrait_mode).materialize()
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_4)
-def source_resample_phase_vert(im_arr, num_slices=None):
+def source_resample_phase_vert(im_arr, num_slices=None, rng=None):
     """
     Vertically slice up image and np.roll each slice by an incremental shift
 
     :param np.ndarray im_arr:
     :param int num_slices:      Number of slices to generate
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    num_slices = num_slices if num_slices else random.choice(range(8, 50))
+    rng = get_rng(rng)
+    num_slices = num_slices if num_slices else rng.choice(range(8, 50))
     _, h = get_np_array_shape(im_arr)
 
-    slices = slice_up_array_uniform(im_arr, num_slices)
+    shifts = get_incremental_shifts(h, num_slices, rng)
+    return roll_slices(im_arr, shifts, slice_axis=1)
 
-    # Have the shifts go in 1 direction
-    shift_rate = random.uniform(0.005, 0.025)
-    direction = random.choice([1, -1])
-    shifts = list(map(lambda x: math.floor(h * x * shift_rate * direction), range(num_slices)))
 
-    slices = [np.roll(slice, axis=0, shift=shift) for slice, shift in zip(slices, shifts)]
-    return np.hstack(slices)
+def get_incremental_shifts(length, num_slices, rng=None):
+    """
+    Pick a random rate and direction, and return that many shifts, growing steadily from 0
+
+    :param int length:      Length of the axis being rolled
+    :param int num_slices:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
+    :return list(int):
+    """
+    rng = get_rng(rng)
+    # Have the shifts go in 1 direction
+    shift_rate = rng.uniform(0.005, 0.025)
+    direction = rng.choice([1, -1])
+    return list(map(lambda x: math.floor(length * x * shift_rate * direction), range(num_slices)))
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_4)
-def source_resample_phase_hor(im_arr, num_slices=None):
+def source_resample_phase_hor(im_arr, num_slices=None, rng=None):
     """
     Horizontally slice up image and np.roll each slice by an incremental shift
 
     :param np.ndarray im_arr:
     :param int num_slices:      Number of slices to generate
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    im_arr = np.rot90(im_arr, k=1)
-    im_arr = source_resample_phase_vert(im_arr, num_slices=num_slices)
-    im_arr = np.rot90(im_arr, k=3)
-    return im_arr
+    rng = get_rng(rng)
+    num_slices = num_slices if num_slices else rng.choice(range(8, 50))
+    w, _ = get_np_array_shape(im_arr)
+
+    # Negated, so strips roll the same way as the vertical version run on the image rotated 90 degrees
+    shifts = [-shift for shift in get_incremental_shifts(w, num_slices, rng)]
+    return roll_slices(im_arr, shifts, slice_axis=0)
 
 
+def remap_resample_grid(rows, cols, num_dups_vert=None, num_dups_hor=None, num_slices_per_dup=None, rng=None):
+    rng = get_rng(rng)
+    num_dups_vert = num_dups_vert if num_dups_vert else rng.choice(range(2,8))
+    num_dups_hor = num_dups_hor if num_dups_hor else rng.choice(range(2, 8))
+    num_slices_per_dup = num_slices_per_dup if num_slices_per_dup else 2 ** rng.choice(range(1, 6))
+
+    row_index = get_resample_index(len(rows), num_dups_hor * num_slices_per_dup, num_dups_hor)
+    col_index = get_resample_index(len(cols), num_dups_vert * num_slices_per_dup, num_dups_vert)
+    return rows[row_index], cols[col_index]
+
+
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_4)
-def source_resample_grid(im_arr, num_dups_vert=None, num_dups_hor=None, num_slices_per_dup=None):
+@apply_index_remap(remap_resample_grid)
+def source_resample_grid(im_arr, num_dups_vert=None, num_dups_hor=None, num_slices_per_dup=None, rng=None):
     """
     Resample crisscrossed slices of an image into a grid of duplicates via uniform sampling
 
@@ -297,58 +490,55 @@ def source_resample_grid(im_arr, num_dups_vert=None, num_dups_hor=None, num_slic
     :param num_dups_vert:
     :param num_dups_hor:
     :param num_slices_per_dup:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    num_dups_vert = num_dups_vert if num_dups_vert else random.choice(range(2,8))
-    num_dups_hor = num_dups_hor if num_dups_hor else random.choice(range(2, 8))
-    num_slices_per_dup = num_slices_per_dup if num_slices_per_dup else 2 ** random.choice(range(1, 6))
-
-    num_slices_vert = num_dups_vert * num_slices_per_dup
-    duped_im_arr = slice_resample_array_vertical(im_arr, num_dups_vert, num_slices_vert)
-    rotated_duped_im_arr = np.rot90(m=duped_im_arr, k=1)     # 90
-
-    num_slices_hor = num_dups_hor * num_slices_per_dup
-    grid_im_arr = slice_resample_array_vertical(rotated_duped_im_arr, num_dups_hor, num_slices_hor)
-    final_im_arr = np.rot90(m=grid_im_arr, k=3)     # 270
-    return final_im_arr
+    return IndexRemap(im_arr).apply(remap_resample_grid, rng=rng, num_dups_vert=num_dups_vert, num_dups_hor=num_dups_hor,
+                                    num_slices_per_dup=num_slices_per_dup).materialize()
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_4)
-def source_resample_random(im_arr):
+def source_resample_random(im_arr, rng=None):
     """
     Apply slice-duping to image array with a randomly-selected method
 
     :param np.ndarray im_arr:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    slice_method = random.choice(SOURCE_RESAMPLE_TRANSFORMS)
+    rng = get_rng(rng)
+    slice_method = rng.choice(SOURCE_RESAMPLE_TRANSFORMS)
     method_name = slice_method.__name__
     logger.info(f"Implementing SLICE method {method_name}")
 
-    sliced_im_arr = slice_method(im_arr)
+    sliced_im_arr = slice_method(im_arr, rng=rng)
     return sliced_im_arr
 
 
+@instrument_stage()
 @apply_transform_cost(COST_LEVEL_5)
-def source_offcrop_recursive(im_arr, mask_text=None):
+def source_offcrop_recursive(im_arr, mask_text=None, rng=None):
     """
     Recursively off-crop an image with itself using a bitmask
 
     :param np.ndarray im_arr:
     :param str mask_text:       If not None, use that as the bitmask.
                                 Otherwise generate a random char for the bitmask.
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    USE_CLEAN_COPY = random_bool()
+    rng = get_rng(rng)
+    USE_CLEAN_COPY = random_bool(rng)
 
     im_arr_a = im_arr.copy()
     im_arr_b = im_arr.copy()
 
     # Collage off-cropped image with another off-crop of itself
-    times = random.choice(range(1, 6))
+    times = rng.choice(range(1, 6))
     for _ in range(times):
-        im_arr_a = crop_im_arr(im_arr_a, cropbox_off_center_random)
-        im_arr_b = crop_im_arr(im_arr_b, cropbox_off_center_random)
+        im_arr_a = crop_im_arr(im_arr_a, cropbox_off_center_random, rng=rng)
+        im_arr_b = crop_im_arr(im_arr_b, cropbox_off_center_random, rng=rng)
 
         # TODO (later) make a method to crop two images according to their shared dimensions
         crop_shape = get_common_crop_shape([im_arr_a, im_arr_b], square=False)
@@ -358,9 +548,10 @@ def source_offcrop_recursive(im_arr, mask_text=None):
         if mask_text:
             bitmask = build_bitmask_to_size(text=mask_text, fontfile=BOOKMAN, shape=crop_shape)
         else:
-            bitmask = build_random_text_bitmask(fontfile=BOOKMAN, shape=crop_shape, numchars=1)
+            bitmask = build_random_text_bitmask(fontfile=BOOKMAN, shape=crop_shape, numchars=1, rng=rng)
 
-        im_arr_a, im_arr_b = simple_bitmask_swap(im_arr_a, im_arr_b, bitmask)
+        # Both working arrays are private copies, so the swap can be done in place
+        im_arr_a, im_arr_b = simple_bitmask_swap(im_arr_a, im_arr_b, bitmask, inplace=True)
 
         if USE_CLEAN_COPY:
             # Reset for next iteration
@@ -400,4 +591,54 @@ SOURCE_TRANSFORMS_COMPLEX = [
     source_offcrop_recursive,
 ]
 
-ALL_TRANSFORMS = SOURCE_TRANSFORMS_COMPLEX + SOURCE_TRANSFORMS_SIMPLE + SOURCE_RESAMPLE_TRANSFORMS
\ No newline at end of file
+ALL_TRANSFORMS = SOURCE_TRANSFORMS_COMPLEX + SOURCE_TRANSFORMS_SIMPLE + SOURCE_RESAMPLE_TRANSFORMS
+
+
+def load_transform_cost_model(path=TRANSFORM_COST_MODEL_PATH):
+    """
+    Load the cost model written by `python bench.py --calibrate` into TRANSFORM_COST_MODEL
+
+    :param str path:
+    :return bool:   False if there is no model at path
+    """
+    try:
+        with open(path) as f:
+            model = json.load(f)['transforms']
+    except FileNotFoundError:
+        return False
+    TRANSFORM_COST_MODEL.clear()
+    TRANSFORM_COST_MODEL.update(model)
+    return True
+
+
+def save_transform_cost_model(model, path=TRANSFORM_COST_MODEL_PATH, meta=None):
+    """
+    Write a cost model to path and load it into TRANSFORM_COST_MODEL
+
+    :param dict model:  transform name -> {'overhead_ms': float, 'ms_per_mp': float}
+    :param str path:
+    :param dict meta:   Anything worth recording about how the model was measured
+    :return:
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'meta': meta or {}, 'transforms': model}, f, indent=2)
+    os.replace(tmp_path, path)
+    TRANSFORM_COST_MODEL.clear()
+    TRANSFORM_COST_MODEL.update(model)
+
+
+def predict_transform_ms(transform, shape):
+    """
+    Predict how long transform takes on an image array of the given shape, from TRANSFORM_COST_MODEL
+
+    :param function transform:
+    :param tuple(int) shape:    (h, w, ...) as in np.ndarray.shape
+    :return float:              Milliseconds, or None if the transform has not been calibrated
+    """
+    cost = TRANSFORM_COST_MODEL.get(transform.__name__)
+    if cost is None:
+        return None
+    megapixels = shape[0] * shape[1] / 1e6
+    return cost['overhead_ms'] + cost['ms_per_mp'] * megapixels
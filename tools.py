@@ -8,14 +8,17 @@ import inspect
 import random
 import logging
 import time
-from collections import defaultdict
+import threading
+import functools
+import contextlib
+import weakref
+import tracemalloc
+from collections import defaultdict, OrderedDict
 
 import numpy as np
 from PIL import Image
-import pillow_avif
 
 from enum import IntEnum, auto
-from matplotlib import pyplot as plt
 
 
 logger = logging.getLogger(__name__)
@@ -24,6 +27,7 @@ logger.setLevel(logging.INFO)
 ROOT = '/Users/josephbertino/Desktop/CodeProjects/denomin8r'
 SOURCE_DIR = os.path.join(ROOT, 'sources')
 FONT_DIR = os.path.join(ROOT, 'fonts')
+CACHE_DIR = os.path.join(ROOT, 'cache')
 BOOKMAN = 'bookman.ttf'  # 'Bookman Old Style Bold'
 
 
@@ -41,6 +45,385 @@ class Colors(IntEnum):
     YELLOW = 0xfffb1c
 
 
+class LRUCache:
+    """
+    Bounded mapping that evicts least-recently-used entries once it holds more than max_entries,
+        or, if max_bytes is given, once the sizeof() of its values sums to more than max_bytes.
+        Safe to share between threads
+    """
+    def __init__(self, max_entries=256, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof if sizeof else (lambda value: 0)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under key (marking it as most recently used), else default
+        :param key:
+        :param default:
+        :return:
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """
+        Store value under key, evicting the least-recently-used entries if over capacity
+        :param key:
+        :param value:
+        :return:
+        """
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self.sizeof(self._data[key])
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self.nbytes += self.sizeof(value)
+            self._evict()
+
+    def resize(self, max_entries=None, max_bytes=None):
+        """
+        Change the capacity of the cache, evicting entries right away if it shrinks
+        :param int max_entries:
+        :param int max_bytes:
+        :return:
+        """
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _evict(self):
+        while self._data and ((len(self._data) > self.max_entries) or
+                              (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, value = self._data.popitem(last=False)
+            self.nbytes -= self.sizeof(value)
+
+
+class BufferPool:
+    """
+    Free lists of scratch arrays keyed by (shape, dtype), so each render iteration can reuse the last one's
+        full-size buffers instead of churning them through the allocator.
+        take() lends out a buffer, give() returns it once nothing reads it any more.
+        At most max_bytes of idle buffers are kept. Safe to share between threads
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.idle_bytes = 0
+        self.peak_bytes = 0  # Most bytes ever pooled, idle and on loan together
+        self.takes = 0
+        self.reuses = 0
+        self._free = defaultdict(list)
+        self._on_loan = weakref.WeakValueDictionary()  # id -> array; forgotten if never given back
+        self._lock = threading.Lock()
+
+    def take(self, shape, dtype=np.uint8):
+        """
+        Lend out an uninitialized array, reusing an idle one if there is one
+        :param tuple(int) shape:
+        :param dtype:
+        :return np.ndarray:
+        """
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            self.takes += 1
+            free = self._free.get(key)
+            if free:
+                self.reuses += 1
+                arr = free.pop()
+                self.idle_bytes -= arr.nbytes
+            else:
+                arr = np.empty(*key)
+            self._on_loan[id(arr)] = arr
+            self.peak_bytes = max(self.peak_bytes, self.idle_bytes + self._loaned_bytes())
+        return arr
+
+    def give(self, *arrs):
+        """
+        Return arrays to the pool. Anything the pool didn't lend out (e.g. a view of a buffer) is ignored,
+            so callers can hand back whatever they're done with
+        :param np.ndarray arrs:
+        :return:
+        """
+        with self._lock:
+            for arr in arrs:
+                if self._on_loan.get(id(arr)) is not arr:
+                    continue
+                del self._on_loan[id(arr)]
+                if self.max_bytes is not None and self.idle_bytes + arr.nbytes > self.max_bytes:
+                    continue
+                self._free[(arr.shape, arr.dtype)].append(arr)
+                self.idle_bytes += arr.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+            self.idle_bytes = 0
+            self.peak_bytes = self._loaned_bytes()
+            self.takes = 0
+            self.reuses = 0
+
+    def stats(self):
+        """
+        :return dict:   Reuse counters, and bytes held idle, on loan and at peak
+        """
+        with self._lock:
+            return {'takes': self.takes, 'reuses': self.reuses,
+                    'reuse_rate': self.reuses / self.takes if self.takes else 0.0,
+                    'idle_bytes': self.idle_bytes, 'loaned_bytes': self._loaned_bytes(),
+                    'peak_bytes': self.peak_bytes}
+
+    def _loaned_bytes(self):
+        return sum(arr.nbytes for arr in self._on_loan.values())
+
+
+# Process-wide pool of the render pipeline's full-size scratch and output arrays, see BufferPool
+BUFFER_POOL_BYTES = 512 * 1024 * 1024
+BUFFER_POOL = BufferPool(max_bytes=BUFFER_POOL_BYTES)
+
+
+def get_rng(rng=None):
+    """
+    Return the RNG a randomized function should draw from: the one it was passed, else the global random module.
+        Pass a random.Random(seed) through to replay a collage exactly
+
+    :param random.Random rng:
+    :return random.Random:
+    """
+    return rng if rng is not None else random
+
+
+# Handed out by StageStats.stage() while instrumentation is disabled
+NULL_STAGE = contextlib.nullcontext()
+
+
+class StageStats:
+    """
+    Per-stage wall time, call counts and allocated bytes for the render pipeline, grouped by iteration.
+        Stages are marked with the instrument_stage decorator or the stage() context manager.
+        While disabled (the default), a stage costs one attribute check.
+        Allocated bytes are the peak traced by tracemalloc above the level at stage entry,
+        and are only recorded when enabled with trace_memory=True.
+        tracemalloc's peak is process-wide, so a stage call that overlaps a stage in another thread
+        (e.g. an ImageWriter save) gets no peak. A peak of None means no call of the stage was measured
+    """
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.iteration = 0
+        self.records = defaultdict(dict)  # iteration -> stage name -> [calls, ns, peak bytes or None]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._traced_threads = 0  # Threads inside a stage that traces memory
+        self._overlaps = 0  # Times a thread entered a traced stage while another thread was in one
+
+    def enable(self, trace_memory=False):
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.trace_memory = False
+
+    def reset(self):
+        with self._lock:
+            self.records.clear()
+            self.iteration = 0
+
+    def set_iteration(self, iteration):
+        """
+        Attribute the stages that run from now on (in threads not bound by in_iteration) to <iteration>
+        :param int iteration:
+        """
+        self.iteration = iteration
+
+    def current_iteration(self):
+        return getattr(self._local, 'iteration', self.iteration)
+
+    @contextlib.contextmanager
+    def in_iteration(self, iteration):
+        """
+        Attribute the stages run by this thread inside the block to <iteration>,
+            e.g. for work handed off to a background thread
+        :param int iteration:
+        """
+        previous = getattr(self._local, 'iteration', None)
+        self._local.iteration = iteration
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self._local.iteration
+            else:
+                self._local.iteration = previous
+
+    def stage(self, name):
+        """
+        Return a context manager that times the block as one call of stage <name>
+        :param str name:
+        """
+        return self._stage(name) if self.enabled else NULL_STAGE
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        peaks = None
+        if self.trace_memory:
+            # Nested stages share tracemalloc's single peak counter, so each stage keeps its own
+            #   running max and hands it up to its parent when it exits
+            peaks = self._local.__dict__.setdefault('peaks', [])
+            with self._lock:
+                overlaps = self._overlaps
+                if not peaks:
+                    self._overlaps += bool(self._traced_threads)
+                    self._traced_threads += 1
+            start_bytes, outer_peak = tracemalloc.get_traced_memory()
+            if peaks:
+                peaks[-1] = max(peaks[-1], outer_peak)
+            tracemalloc.reset_peak()
+            peaks.append(start_bytes)
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            nbytes = None
+            if peaks is not None:
+                peak = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if peaks:
+                    peaks[-1] = max(peaks[-1], peak)
+                with self._lock:
+                    if self._overlaps == overlaps:  # No other thread's allocations mixed in
+                        nbytes = peak - start_bytes
+                    if not peaks:
+                        self._traced_threads -= 1
+            self.add(name, elapsed, nbytes)
+
+    def add(self, name, ns, nbytes=None, calls=1, iteration=None):
+        iteration = self.current_iteration() if iteration is None else iteration
+        with self._lock:
+            record = self.records[iteration].setdefault(name, [0, 0, None])
+            record[0] += calls
+            record[1] += ns
+            record[2] = max_known(record[2], nbytes)
+
+    def merge(self, records, iteration=None):
+        """
+        Fold in records taken elsewhere, e.g. returned from a worker process by capture()
+
+        :param dict records:    stage name -> [calls, ns, peak bytes]
+        :param int iteration:   Defaults to the current iteration
+        """
+        for name, (calls, ns, nbytes) in records.items():
+            self.add(name, ns, nbytes, calls=calls, iteration=iteration)
+
+    def capture(self, fn, *args, **kwargs):
+        """
+        Call fn and return its result together with the records of the stages it ran.
+            Meant to be run in a worker process, whose records would otherwise be lost
+
+        :param function fn:
+        :return tuple:      (result, records for merge())
+        """
+        self.reset()
+        result = fn(*args, **kwargs)
+        with self._lock:
+            records = {name: list(record) for iter_records in self.records.values()
+                       for name, record in iter_records.items()}
+        self.reset()
+        return result, records
+
+    def summary(self):
+        """
+        Return the records as a structured dict: totals per stage, and each iteration's records
+        :return dict:
+        """
+        with self._lock:
+            iterations = {iteration: {name: dict(calls=calls, ms=ns / 1e6, peak_bytes=nbytes)
+                                      for name, (calls, ns, nbytes) in iter_records.items()}
+                          for iteration, iter_records in sorted(self.records.items())}
+
+        totals = {}
+        for iter_records in iterations.values():
+            for name, record in iter_records.items():
+                total = totals.setdefault(name, dict(calls=0, ms=0.0, max_iteration_ms=0.0, peak_bytes=None))
+                total['calls'] += record['calls']
+                total['ms'] += record['ms']
+                total['max_iteration_ms'] = max(total['max_iteration_ms'], record['ms'])
+                total['peak_bytes'] = max_known(total['peak_bytes'], record['peak_bytes'])
+        totals = dict(sorted(totals.items(), key=lambda item: item[1]['ms'], reverse=True))
+        return {'stages': totals, 'iterations': iterations}
+
+
+STAGE_STATS = StageStats()
+
+
+def max_known(a, b):
+    """
+    max() of two values that may be None (unknown)
+    :return:    None if both are
+    """
+    if a is None:
+        return b
+    return a if b is None else max(a, b)
+
+
+def capture_stage_stats(fn, *args, **kwargs):
+    """
+    Module-level form of STAGE_STATS.capture(), so it can be submitted to a process pool
+    :return tuple:  (result of fn, records for StageStats.merge())
+    """
+    return STAGE_STATS.capture(fn, *args, **kwargs)
+
+
+def instrument_stage(name=None):
+    """
+    Decorator method to record every call of the function as a stage in STAGE_STATS
+
+    :param str name:    Stage name, defaults to the function name
+    :return:
+    """
+    def wrapper(fn):
+        stage_name = name if name else fn.__name__
+
+        @functools.wraps(fn)
+        def instrumented(*args, **kwargs):
+            if not STAGE_STATS.enabled:
+                return fn(*args, **kwargs)
+            with STAGE_STATS.stage(stage_name):
+                return fn(*args, **kwargs)
+        return instrumented
+    return wrapper
+
+
 def get_sig_details(func):
     """
     Return list of parameter details for func
@@ -73,13 +456,15 @@ def get_array_square_shape(arr):
     return [min(arr.shape[:2])] * 2
 
 
-def build_random_string(k=1):
+def build_random_string(k=1, rng=None):
     """
     Build a random string of the given length. Only AlphaNum chars
     :param int k:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return str:
     """
-    res = ''.join(random.choices(string.ascii_uppercase + string.digits, k=k))
+    rng = get_rng(rng)
+    res = ''.join(rng.choices(string.ascii_uppercase + string.digits, k=k))
     return res
 
 
@@ -110,9 +495,10 @@ def ffloor(n):
         return math.floor(n) + 1
 
 
-def random_bool():
+def random_bool(rng=None):
     """Return True/False at random"""
-    return random.choice([True, False])
+    rng = get_rng(rng)
+    return rng.choice([True, False])
 
 
 def get_char_widths(text, font):
@@ -189,16 +575,34 @@ def get_np_array_shape(arr):
     return tuple(list(arr.shape[:2])[::-1])
 
 
-def slice_up_array_uniform(arr, num_slices=None):
+def get_pixel_view(im_arr):
+    """
+    View an (..., h, w, c) image array as (..., h, w), with each pixel's channels packed into one opaque element.
+        Masked copies and gathers over such a view move whole pixels, instead of broadcasting across channels
+
+    :param np.ndarray im_arr:   A 2-D array is taken to be single-channel and returned as is
+    :return np.ndarray:         None if the channels of a pixel aren't adjacent in memory
+    """
+    if im_arr.ndim == 2:
+        return im_arr
+    try:
+        return im_arr.view(f'V{im_arr.shape[-1] * im_arr.itemsize}')[..., 0]
+    except ValueError:
+        return None
+
+
+def slice_up_array_uniform(arr, num_slices=None, rng=None):
     """
     Slice up an image into uniform vertical strips and return an np.ndarray of those slices
         Number of slices should be a power of 2
 
     :param np.ndarray arr:      Array
     :param int num_slices:      Number of slices to generate
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:         Array of <num_slices> strips
     """
-    num_slices = num_slices if num_slices else 2 ** random.choice(range(1, 6))
+    rng = get_rng(rng)
+    num_slices = num_slices if num_slices else 2 ** rng.choice(range(1, 6))
 
     w, h = get_np_array_shape(arr)
     slice_width = math.ceil(w / num_slices)
@@ -208,7 +612,186 @@ def slice_up_array_uniform(arr, num_slices=None):
     return slices
 
 
-def slice_resample_array_vertical(arr, num_dups=None, num_slices=None):
+def get_slice_bounds(length, num_slices):
+    """
+    Return the (start, stop) of each uniform slice along an axis, cut the same way as slice_up_array_uniform()
+
+    :param int length:          Length of the axis being sliced
+    :param int num_slices:
+    :return list(tuple(int)):
+    """
+    slice_width = math.ceil(length / num_slices)
+    return [(min(i * slice_width, length), min((i + 1) * slice_width, length)) for i in range(num_slices)]
+
+
+def build_slice_order_index(length, num_slices, order, flip_odd=False):
+    """
+    Build the index map that lays out the uniform slices of an axis in the given order.
+        Applying it with take_columns() / take_rows() replaces slicing up an array and np.hstack-ing the pieces
+
+    :param int length:          Length of the axis being sliced
+    :param int num_slices:
+    :param tuple(int) order:    Slice numbers, in their new order
+    :param bool flip_odd:       If True, reverse every odd-numbered slice
+    :return np.ndarray:
+    """
+    bounds = get_slice_bounds(length, num_slices)
+    pieces = []
+    for i in order:
+        start, stop = bounds[i]
+        piece = np.arange(start, stop)
+        pieces.append(piece[::-1] if (flip_odd and i % 2) else piece)
+    return np.concatenate(pieces)
+
+
+@functools.lru_cache(maxsize=512)
+def get_slice_order_index(length, num_slices, order, flip_odd=False):
+    """
+    Cached, read-only version of build_slice_order_index(), for slice orders that come up again and again
+    :return np.ndarray:
+    """
+    index = build_slice_order_index(length, num_slices, order, flip_odd)
+    index.flags.writeable = False
+    return index
+
+
+@functools.lru_cache(maxsize=512)
+def get_resample_index(length, num_slices, num_dups):
+    """
+    Index map that reorders uniform slices into <num_dups> samples of the original axis,
+        i.e. every num_dups'th slice, for each of the num_dups offsets
+
+    :param int length:          Length of the axis being sliced
+    :param int num_slices:
+    :param int num_dups:
+    :return np.ndarray:
+    """
+    order = tuple(i for dup_i in range(num_dups) for i in range(dup_i, num_slices, num_dups))
+    return get_slice_order_index(length, num_slices, order)
+
+
+def take_columns(arr, col_index, out=None):
+    """
+    Gather the columns of an array according to an index map.
+        Runs of consecutive columns are block-copied, which beats an element-wise np.take
+        when the map is made up of a modest number of slices
+
+    :param np.ndarray arr:
+    :param np.ndarray col_index:
+    :param np.ndarray out:      Optional buffer to gather into, shaped like the result
+    :return np.ndarray:
+    """
+    run_starts = np.flatnonzero(np.diff(col_index) != 1) + 1
+    if len(run_starts) * 16 > len(col_index):
+        # np.take buffers its output in the default mode='raise'; the index is in range, so clip skips that
+        return np.take(arr, col_index, axis=1, out=out, mode='clip' if out is not None else 'raise')
+
+    if out is None:
+        out = np.empty((arr.shape[0], len(col_index)) + arr.shape[2:], dtype=arr.dtype)
+    run_bounds = [0, *run_starts.tolist(), len(col_index)]
+    for start, stop in zip(run_bounds[:-1], run_bounds[1:]):
+        src_start = col_index[start]
+        out[:, start:stop] = arr[:, src_start:(src_start + stop - start)]
+    return out
+
+
+def take_rows(arr, row_index, out=None):
+    """
+    Gather the rows of an array according to an index map
+
+    :param np.ndarray arr:
+    :param np.ndarray row_index:
+    :param np.ndarray out:      Optional buffer to gather into, shaped like the result
+    :return np.ndarray:
+    """
+    return np.take(arr, row_index, axis=0, out=out, mode='clip' if out is not None else 'raise')
+
+
+def make_shape_proxy(h, w):
+    """
+    Return a zero-memory stand-in for an (h, w) array, for helpers that only look at an array's shape
+        (e.g. the CROPBOX_OPERATIONS)
+
+    :param int h:
+    :param int w:
+    :return np.ndarray:
+    """
+    return np.broadcast_to(np.uint8(0), (h, w))
+
+
+def get_axis_slice(index):
+    """
+    Return the slice equivalent to an index map, if it is a single run stepping by +1 or -1
+
+    :param np.ndarray index:
+    :return slice:              None if the index map isn't a single run
+    """
+    if len(index) < 2:
+        return None
+    step = int(index[1] - index[0])
+    if step not in (1, -1) or int(index[-1] - index[0]) != step * (len(index) - 1):
+        return None
+    if not (np.diff(index) == step).all():
+        return None
+    stop = int(index[-1]) + step
+    return slice(int(index[0]), stop if stop >= 0 else None, step)
+
+
+class IndexRemap:
+    """
+    Lazily composed coordinate remap of an image array: pixel (y, x) of the result is im_arr[rows[y], cols[x]].
+        Flips, rolls, crops and slice permutations only rearrange rows and columns, so a chain of them
+        is recorded by composing the index maps, and the pixels are gathered once by materialize()
+    """
+    def __init__(self, im_arr):
+        self.im_arr = im_arr
+        h, w = im_arr.shape[:2]
+        self.rows = self._identity_rows = np.arange(h)
+        self.cols = self._identity_cols = np.arange(w)
+
+    @property
+    def shape(self):
+        return (len(self.rows), len(self.cols)) + self.im_arr.shape[2:]
+
+    def apply(self, remap, **kwargs):
+        """
+        Compose a remap onto the pipeline
+        :param function remap:  Takes (rows, cols, **kwargs) and returns the remapped (rows, cols)
+        :return IndexRemap:
+        """
+        self.rows, self.cols = remap(self.rows, self.cols, **kwargs)
+        return self
+
+    def materialize(self, pool=None):
+        """
+        Gather the remapped pixels. Single runs of rows / columns (e.g. crops and flips) come back as views
+        :param BufferPool pool:     If given, gather into buffers taken from it
+        :return np.ndarray:
+        """
+        def get_out(shape):
+            return pool.take(shape, self.im_arr.dtype) if pool else None
+
+        im_arr = self.im_arr
+        if self.rows is not self._identity_rows:
+            row_slice = get_axis_slice(self.rows)
+            if row_slice:
+                im_arr = im_arr[row_slice]
+            else:
+                im_arr = take_rows(im_arr, self.rows, out=get_out((len(self.rows),) + im_arr.shape[1:]))
+        if self.cols is not self._identity_cols:
+            col_slice = get_axis_slice(self.cols)
+            if col_slice:
+                im_arr = im_arr[:, col_slice]
+            else:
+                gathered = take_columns(im_arr, self.cols,
+                                        out=get_out(im_arr.shape[:1] + (len(self.cols),) + im_arr.shape[2:]))
+                if pool:
+                    pool.give(im_arr)  # The rows gathered above, if any
+                im_arr = gathered
+        return im_arr
+
+
+def slice_resample_array_vertical(arr, num_dups=None, num_slices=None, rng=None):
     """
     Slice up array into vertical strips and reorder strips
         to form <num_dups> samples of original image
@@ -216,31 +799,73 @@ def slice_resample_array_vertical(arr, num_dups=None, num_slices=None):
     :param np.ndarray arr:
     :param num_dups:
     :param num_slices:          Number of slices to generate
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray:
     """
-    num_slices = num_slices if num_slices else 2 ** random.choice(range(1, 6))
-    num_dups = num_dups if num_dups else random.choice(range(2,8))
+    rng = get_rng(rng)
+    num_slices = num_slices if num_slices else 2 ** rng.choice(range(1, 6))
+    num_dups = num_dups if num_dups else rng.choice(range(2,8))
 
-    slices = slice_up_array_uniform(arr, num_slices)
-    stack = []
-    for dup_i in range(num_dups):
-        stack.extend(slices[dup_i::num_dups])
-    return np.hstack(stack)
+    w, h = get_np_array_shape(arr)
+    return take_columns(arr, get_resample_index(w, num_slices, num_dups))
 
 
-def profile_time_source_transform(fn, im_arr):
+def profile_time_source_transform(fn, im_arr, reps=40):
     """
     :param fn:
     :param im_arr:
+    :param int reps:    Number of times to call fn
     :return int: Nanoseconds to complete fn
     """
     start = time.perf_counter_ns()
-    for _ in range(40):
+    for _ in range(reps):
         fn(im_arr)
     end = time.perf_counter_ns()
     return end - start
 
 
+def profile_sample_times(fn, reps=40, warmup=1, setup=None):
+    """
+    Time each of <reps> calls of fn() separately, after <warmup> untimed calls
+
+    :param function fn:     Called with no arguments
+    :param int reps:
+    :param int warmup:
+    :param function setup:  If given, called (untimed) before every call of fn, e.g. to clear caches
+    :return list(int):      Nanoseconds taken by each timed call
+    """
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+
+    times = []
+    for _ in range(reps):
+        if setup:
+            setup()
+        start = time.perf_counter_ns()
+        fn()
+        times.append(time.perf_counter_ns() - start)
+    return times
+
+
+def profile_summarize_times(times, megapixels):
+    """
+    Summarize per-call times as median/p95 latency and throughput
+
+    :param list(int) times:     Nanoseconds per call, see profile_sample_times
+    :param float megapixels:    Size of the input processed by each call
+    :return dict:               median_ms, p95_ms, mp_per_s (throughput at the median)
+    """
+    median_ns = float(np.median(times))
+    p95_ns = float(np.percentile(times, 95))
+    return {
+        'median_ms': median_ns / 1e6,
+        'p95_ms': p95_ns / 1e6,
+        # A call too fast for the clock still took at least 1ns; this keeps mp_per_s finite (and valid JSON)
+        'mp_per_s': megapixels / (max(median_ns, 1) / 1e9),
+    }
+
 
 def profile_normalize_times(fn_times):
     """
@@ -263,6 +888,8 @@ def profile_bar_chart(indices, values, index_label, value_label, title=''):
     :param str value_label:
     :return:
     """
+    from matplotlib import pyplot as plt  # Slow to import, and only needed for profiling plots
+
     bars = plt.bar(indices, values, color='g', width=0.25, edgecolor='grey')
     plt.xlabel(index_label, fontweight='bold', fontsize=15)
     plt.xticks(rotation=90)
@@ -273,20 +900,23 @@ def profile_bar_chart(indices, values, index_label, value_label, title=''):
     plt.show()
 
 
-def profile_and_plot_fns(fn_list, im_arr):
+def profile_and_plot_fns(fn_list, im_arr, reps=40, plot=True):
     """
     :param list fn_list:
     :param np.ndarray im_arr:
+    :param int reps:    Number of times to call each fn
+    :param bool plot:   If False, skip the bar chart (e.g. on a headless machine)
     :return:
     """
     name_times = []
     for fn in fn_list:
-        total_time = profile_time_source_transform(fn, im_arr)
+        total_time = profile_time_source_transform(fn, im_arr, reps=reps)
         name_times.append((fn.__name__, total_time))
     # name_times = sorted(name_times, key=lambda x: x[1])
     fn_names, fn_times = list(zip(*name_times))
     norm_times = profile_normalize_times(fn_times)
-    profile_bar_chart(fn_names, norm_times, "Transform", "Relative Time (%)")
+    if plot:
+        profile_bar_chart(fn_names, norm_times, "Transform", "Relative Time (%)")
     return list(fn_names), list(norm_times)
 
 
@@ -318,6 +948,34 @@ def get_common_crop_shape(crop_list, square=True):
         return w, h
 
 
+def get_aspect_crop_shape(shape, aspect):
+    """
+    Return the largest shape (w, h) with the given aspect ratio that fits within shape
+
+    :param tuple(int) shape:    (w, h)
+    :param float aspect:        w / h
+    :return (int, int):         width, height
+    """
+    w, h = shape
+    if w / h > aspect:
+        return max(1, round(h * aspect)), h
+    return w, max(1, round(w / aspect))
+
+
+def iter_tiles(shape, tile_size):
+    """
+    Cover shape with tiles of at most tile_size x tile_size, row by row
+
+    :param tuple(int) shape:    (w, h)
+    :param int tile_size:
+    :return generator:          Boxes (left, top, right, bottom)
+    """
+    w, h = shape
+    for top in range(0, h, tile_size):
+        for left in range(0, w, tile_size):
+            yield left, top, min(left + tile_size, w), min(top + tile_size, h)
+
+
 def cropbox_central_shape(im_arr, crop_shape=None):
     """
     Return the cropbox for an image, where you crop from the center for a given shape
@@ -337,14 +995,16 @@ def cropbox_central_shape(im_arr, crop_shape=None):
     return central_crop_box
 
 
-def cropbox_off_center_random(im_arr):
+def cropbox_off_center_random(im_arr, rng=None):
     """
     Get Off-Center cropbox for image based on random "jitter"
 
     :param np.ndarray im_arr:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return (int, int, int, int):   left, top, right, bottom
     """
-    jitter = float(random.choice(range(5, 10)) / 100)
+    rng = get_rng(rng)
+    jitter = float(rng.choice(range(5, 10)) / 100)
     crop_cap = 1.0 - jitter
 
     # Determine size of image
@@ -358,8 +1018,8 @@ def cropbox_off_center_random(im_arr):
 
     # determine origin point for image crops
     orig_crop_box = cropbox_central_shape(im_arr, crop_shape)
-    jitter_w = ffloor(max_jitter * random.uniform(-1, 1))
-    jitter_h = ffloor(max_jitter * random.uniform(-1, 1))
+    jitter_w = ffloor(max_jitter * rng.uniform(-1, 1))
+    jitter_h = ffloor(max_jitter * rng.uniform(-1, 1))
 
     # apply jitter_w and jitter_h to crop_box
     left, top, right, bottom = orig_crop_box
@@ -368,11 +1028,12 @@ def cropbox_off_center_random(im_arr):
     return jitter_crop_box
 
 
-def cropbox_central_square(im_arr):
+def cropbox_central_square(im_arr, rng=None):
     """
     Return cropbox for max-square within image array, centralized
 
     :param np.ndarray im_arr:
+    :param random.Random rng:   Unused, accepted so every CROPBOX_OPERATIONS method can be called the same way
     :return tuple(int):
     """
     return cropbox_central_shape(im_arr, get_array_square_shape(im_arr))
@@ -1,39 +1,333 @@
+import io
 import uuid
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
-from sortedcontainers import SortedSet
-import PySimpleGUI as sg
 
 from source_ops import *
 
 SOURCE_FILES = None
 
+# Decoded source arrays, keyed by (filename, mtime). Adjust the budget with SOURCE_CACHE.resize(max_bytes=...)
+SOURCE_CACHE_BYTES = 1024 * 1024 * 1024
+SOURCE_CACHE = LRUCache(max_entries=256, max_bytes=SOURCE_CACHE_BYTES, sizeof=lambda im_arr: im_arr.nbytes)
+
+# Directory of the pre-decoded source store. None means the store is disabled (see enable_source_store)
+SOURCE_STORE = None
+SOURCE_STORE_PATH = os.path.join(CACHE_DIR, 'source_store')
+
+# Index of the source library, kept on disk so prep() only has to look at new or changed files.
+#   Maps filename -> {'mtime', 'size', 'w', 'h', 'mode', 'orientation', 'hash'}, all read from file headers
+#   (w, h as decoded, before any EXIF orientation). Updated in place by prep(). See select_sources()
+SOURCE_MANIFEST = {}
+SOURCE_MANIFEST_PATH = os.path.join(CACHE_DIR, 'source_manifest.json')
+SOURCE_MANIFEST_VERSION = 2  # Bump when entries gain fields, to re-index every source
+EXIF_ORIENTATION = 0x0112
+# Tiled print rendering, see render_tiled_collages
+PRINT_TILE_SIZE = 2048
+PRINT_MASK_SIZE = 4096  # The bitmask is rasterized at no more than this many px per side, then resampled
+PREP_WORKERS = None  # Processes converting and indexing new sources. None means one per CPU
+
+
 # TODO (later) I will have to get smarter about organizing my static source images. Will I have to start naming the files more sensibly? That sounds like a lot of work.
-def prep():
+def prep(full_scan=False):
     """
     1) All .webp files converted to .jpg
     2) All files with extension '.jpeg' renamed to '.jpg'
+    3) New or changed sources are indexed into SOURCE_MANIFEST, and SOURCE_FILES is rebuilt from it
+    4) If enabled, the pre-decoded source store is brought up to date
+
+    Conversion and indexing run in a process pool. If nothing was added to, removed from or renamed in SOURCE_DIR
+        since the last run (i.e. its mtime is unchanged), the manifest is trusted without a stat per file.
+
+    :param bool full_scan:  If True, stat every source even if SOURCE_DIR looks unchanged,
+                                e.g. after editing a source in place
+    :return:
     """
     global SOURCE_FILES
 
-    for root, dirs, files in os.walk("./sources/"):
-        for file in files:
-            if file == '.DS_Store':
-                continue
-            fname = file.rsplit('.', maxsplit=1)[0]
-            new_file_path = os.path.join(root, fname + '.jpg')
-            if not file.endswith('.jpg'):
-                filepath = os.path.join(root, file)
-                image = Image.open(filepath).convert(mode='RGB')
-                image.save(new_file_path, format="JPEG")
-                os.remove(filepath)
-
-    # TODO will have to refactor this when I reorganize my sources
-    os.chdir(SOURCE_DIR)
-    SOURCE_FILES = SortedSet([f for f in os.listdir() if
-                              (f != '.DS_Store' and os.path.isfile(os.path.join(SOURCE_DIR, f)))],
-                             key=os.path.getmtime)
+    manifest = read_source_manifest()
+    if manifest.get('version') != SOURCE_MANIFEST_VERSION:
+        manifest = {}
+    dir_mtime = os.stat(SOURCE_DIR).st_mtime
+    if full_scan or (manifest.get('source_dir_mtime') != dir_mtime) or not manifest.get('sources'):
+        sources = scan_sources(manifest.get('sources', {}))
+        # Conversions touch SOURCE_DIR, so take its mtime afterwards
+        write_source_manifest({'version': SOURCE_MANIFEST_VERSION, 'source_dir_mtime': os.stat(SOURCE_DIR).st_mtime,
+                               'sources': sources})
+    else:
+        sources = manifest['sources']
+
+    SOURCE_MANIFEST.clear()
+    SOURCE_MANIFEST.update(sources)
+    SOURCE_FILES = sorted(SOURCE_MANIFEST, key=lambda f: (SOURCE_MANIFEST[f]['mtime'], f))
     os.chdir(ROOT)
 
+    if SOURCE_STORE:
+        refresh_source_store(SOURCE_FILES)
+
+
+def scan_sources(known_sources):
+    """
+    Stat every file in SOURCE_DIR, converting non-JPEGs and indexing any file that is new or
+        whose mtime or size differ from known_sources
+
+    :param dict known_sources:  filename -> manifest entry, from the last scan
+    :return dict:               filename -> manifest entry, for every source now in SOURCE_DIR
+    """
+    sources = {}
+    to_index = []
+    with os.scandir(SOURCE_DIR) as entries:
+        for entry in entries:
+            if entry.name == '.DS_Store' or not entry.is_file():
+                continue
+            known = known_sources.get(entry.name)
+            stat = entry.stat()
+            if known and known['mtime'] == stat.st_mtime and known['size'] == stat.st_size:
+                sources[entry.name] = known
+            else:
+                to_index.append(entry.name)
+
+    if len(to_index) > 1:
+        with ProcessPoolExecutor(max_workers=PREP_WORKERS) as pool:
+            indexed = list(pool.map(functools.partial(index_source, source_dir=SOURCE_DIR), to_index, chunksize=8))
+    else:
+        indexed = [index_source(filename) for filename in to_index]
+    sources.update(indexed)
+
+    logger.info(f"Source manifest: indexed {len(to_index)} of {len(sources)} sources")
+    return sources
+
+
+def index_source(filename, source_dir=None):
+    """
+    Convert a source to .jpg if needed, then measure it for the manifest. Runs in a prep() worker process
+
+    :param str filename:    Name of a file in SOURCE_DIR
+    :param str source_dir:  Defaults to SOURCE_DIR
+    :return (str, dict):    Filename of the .jpg, and its manifest entry
+    """
+    source_dir = source_dir if source_dir else SOURCE_DIR
+    filepath = os.path.join(source_dir, filename)
+    if not filename.endswith('.jpg'):
+        import pillow_avif  # Registers the AVIF decoder with PIL, only needed to convert .avif sources
+        filename = filename.rsplit('.', maxsplit=1)[0] + '.jpg'
+        new_file_path = os.path.join(source_dir, filename)
+        with Image.open(filepath) as image:
+            image.convert(mode='RGB').save(new_file_path, format="JPEG")
+        os.remove(filepath)
+        filepath = new_file_path
+
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    with Image.open(filepath) as img:  # Reads just the header
+        w, h = img.size
+        mode = img.mode
+        orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+
+    stat = os.stat(filepath)
+    return filename, {'mtime': stat.st_mtime, 'size': stat.st_size, 'w': w, 'h': h, 'mode': mode,
+                      'orientation': orientation, 'hash': hasher.hexdigest()}
+
+
+def read_source_manifest(path=SOURCE_MANIFEST_PATH):
+    """
+    :param str path:
+    :return dict:   Empty if there is no readable manifest
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_source_manifest(manifest, path=SOURCE_MANIFEST_PATH):
+    """
+    :param dict manifest:
+    :param str path:
+    :return:
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def get_source_files():
+    """
+    Return SOURCE_FILES as set by the last prep(). Modules that star-import util only have the value it had then
+    :return list(str):
+    """
+    return SOURCE_FILES
+
+
+def get_source_info(filename):
+    """
+    :param str filename:
+    :return dict:   The source's SOURCE_MANIFEST entry
+    """
+    return SOURCE_MANIFEST[filename]
+
+
+def select_sources(min_size=0, modes=None, filenames=None):
+    """
+    Return the sources that match, judged from SOURCE_MANIFEST without decoding anything
+
+    :param int min_size:        Minimum length of the shorter side, i.e. of the largest square crop
+    :param list(str) modes:     If given, PIL modes to accept, e.g. ['RGB']
+    :param list(str) filenames: Sources to choose from, defaults to SOURCE_FILES
+    :return list(str):          In the order of filenames
+    """
+    filenames = SOURCE_FILES if filenames is None else filenames
+    selected = []
+    for filename in filenames:
+        info = SOURCE_MANIFEST[filename]
+        if min(info['w'], info['h']) < min_size:
+            continue
+        if modes and info['mode'] not in modes:
+            continue
+        selected.append(filename)
+    return selected
+
+
+def select_source_pairs(min_square=0, n=1, modes=None, rng=None):
+    """
+    Pick <n> pairs of distinct sources whose common square crop is at least min_square px, without decoding.
+        A pair qualifies exactly when both of its sources do, so pairs are drawn from select_sources()
+
+    :param int min_square:
+    :param int n:
+    :param list(str) modes:     See select_sources
+    :param random.Random rng:   Source of randomness, defaults to the global random module
+    :return list((str, str)):   Empty if fewer than 2 sources qualify
+    """
+    rng = get_rng(rng)
+    candidates = select_sources(min_size=min_square, modes=modes)
+    if len(candidates) < 2:
+        return []
+    return [tuple(rng.sample(candidates, 2)) for _ in range(n)]
+
+
+def get_sources_crop_shape(filenames, square=True):
+    """
+    Like get_common_crop_shape, but for sources that haven't been decoded, using their SOURCE_MANIFEST dimensions
+
+    :param list(str) filenames:
+    :param bool square:
+    :return (int, int):     width, height
+    """
+    return get_common_crop_shape([(0, 0, SOURCE_MANIFEST[f]['w'], SOURCE_MANIFEST[f]['h']) for f in filenames],
+                                 square=square)
+
+
+def enable_source_store(path=SOURCE_STORE_PATH):
+    """
+    Keep every source pre-decoded as a raw .npy file, so load_sources can memory-map it instead of decoding.
+        Call before prep(), which decodes whatever is new or changed into the store
+
+    :param str path:
+    :return:
+    """
+    global SOURCE_STORE
+    SOURCE_STORE = path
+    os.makedirs(SOURCE_STORE, exist_ok=True)
+
+
+def disable_source_store():
+    global SOURCE_STORE
+    SOURCE_STORE = None
+
+
+def get_stored_source_path(filename):
+    return os.path.join(SOURCE_STORE, filename + '.npy')
+
+
+def refresh_source_store(filenames):
+    """
+    Decode into the store every source that is missing from it or changed since it was stored,
+        and drop stored sources that no longer exist
+
+    :param list(str) filenames:
+    :return int:                Number of sources decoded
+    """
+    num_decoded = 0
+    for filename in filenames:
+        if open_stored_source(filename) is not None:
+            continue
+        with Image.open(os.path.join(SOURCE_DIR, filename)) as img:
+            im_arr = np.array(img)
+        # Write through a temp file so no process ever maps a partial array
+        store_path = get_stored_source_path(filename)
+        tmp_path = f"{store_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, im_arr)
+        os.replace(tmp_path, store_path)
+        num_decoded += 1
+
+    stored_names = set(f + '.npy' for f in filenames)
+    for stored_name in os.listdir(SOURCE_STORE):
+        if stored_name.endswith('.npy') and stored_name not in stored_names:
+            os.remove(os.path.join(SOURCE_STORE, stored_name))
+
+    logger.info(f"Source store: decoded {num_decoded} of {len(filenames)} sources")
+    return num_decoded
+
+
+def open_stored_source(filename):
+    """
+    Memory-map a source from the store. The array is read-only and backed by the OS page cache,
+        so it costs no decode and is shared between processes
+
+    :param str filename:
+    :return np.ndarray:     None if the source isn't stored, or is older than the source file
+    """
+    store_path = get_stored_source_path(filename)
+    try:
+        if os.path.getmtime(store_path) < os.path.getmtime(os.path.join(SOURCE_DIR, filename)):
+            return None
+    except FileNotFoundError:
+        return None
+    return np.load(store_path, mmap_mode='r')
+
+
+def get_render_worker_state():
+    """
+    Return the state that prep() and the enable_*_store() calls set up in this process,
+        as the arguments for init_render_worker() in a worker process
+
+    :return tuple:
+    """
+    stage_stats = (STAGE_STATS.enabled, STAGE_STATS.trace_memory)
+    return list(SOURCE_FILES), dict(SOURCE_MANIFEST), SOURCE_STORE, get_fit_size_store(), stage_stats
+
+
+def init_render_worker(source_files, source_manifest, source_store, fit_size_store, stage_stats=(False, False)):
+    """
+    Initializer for render worker processes, taking the output of get_render_worker_state()
+
+    :param list(str) source_files:
+    :param dict source_manifest:
+    :param str source_store:
+    :param str fit_size_store:
+    :param tuple(bool) stage_stats: Whether STAGE_STATS is enabled, and whether it traces memory
+    :return:
+    """
+    global SOURCE_FILES, SOURCE_STORE
+    SOURCE_FILES = source_files
+    SOURCE_MANIFEST.clear()
+    SOURCE_MANIFEST.update(source_manifest)
+    SOURCE_STORE = source_store
+    if fit_size_store:
+        enable_fit_size_store(fit_size_store, compact=False)
+    enabled, trace_memory = stage_stats
+    if enabled:
+        STAGE_STATS.enable(trace_memory=trace_memory)
+
 
 def get_specific_sources(srcs):
     """
@@ -52,16 +346,56 @@ def get_specific_sources(srcs):
     return filenames
 
 
-def load_sources(latest=True, n=2, specific_srcs=None):
+def decode_source(filename, use_cache=True, target_size=None):
+    """
+    Decode a source image from SOURCE_DIR into an np.ndarray.
+        Arrays are cached in SOURCE_CACHE and are read-only, so transforms can't corrupt a cached source.
+        At full resolution, a source in the store (see enable_source_store) is memory-mapped instead
+
+    :param str filename:
+    :param bool use_cache:
+    :param int target_size: If given, let the JPEG decoder scale down by 1/2, 1/4 or 1/8,
+                                as far as it can while keeping both sides at least target_size
+    :return np.ndarray:
     """
-    Return images from the '/sources' directory, converted into np.ndarray's
+    if SOURCE_STORE and not target_size:
+        im_arr = open_stored_source(filename)
+        if im_arr is not None:
+            return im_arr
+
+    filepath = os.path.join(SOURCE_DIR, filename)
+    key = (filename, os.path.getmtime(filepath), target_size)
+    im_arr = SOURCE_CACHE.get(key) if use_cache else None
+    if im_arr is None:
+        with Image.open(filepath) as img:
+            if target_size:
+                # Image.draft() picks the largest DCT scaling that keeps the image at least this size
+                img.draft('RGB', (target_size, target_size))
+            im_arr = np.array(img)
+        im_arr.flags.writeable = False
+        if use_cache:
+            SOURCE_CACHE.put(key, im_arr)
+    return im_arr
+
+
+@instrument_stage()
+def load_sources(latest=True, n=2, specific_srcs=None, use_cache=True, target_size=None, min_size=0, rng=None):
+    """
+    Return images from the '/sources' directory, converted into read-only np.ndarray's
 
     :param bool latest: If True, get latest images according to image filename
     :param int n:       Number of source images to grab
     :param list(str) specific_srcs: If not empty, a list of source files to grab before grabbing the rest
+    :param bool use_cache: If True, reuse arrays already decoded by earlier calls (see decode_source)
+    :param int target_size: If given, decode at reduced resolution, as long as both sides of each
+                                image stay at least target_size (see decode_source)
+    :param int min_size:    Only pick sources whose shorter side is at least min_size (see select_sources).
+                                Doesn't apply to specific_srcs
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return list(np.ndarray):
     """
-    random.seed()
+    rng = get_rng(rng)
+    candidates = select_sources(min_size=min_size) if min_size else SOURCE_FILES
 
     filenames = []
     if specific_srcs:
@@ -69,35 +403,46 @@ def load_sources(latest=True, n=2, specific_srcs=None):
         n -= len(filenames)
 
     if n:
+        if len(candidates) < n:
+            raise ValueError(f"Need {n} more sources, but only {len(candidates)} have both sides >= {min_size}px")
         if latest:
-            filenames.extend(SOURCE_FILES[(-1 * n):])
+            filenames.extend(candidates[(-1 * n):])
         else:
-            filenames.extend(random.sample(SOURCE_FILES, n))
+            filenames.extend(rng.sample(candidates, n))
 
-    source_images = [Image.open(os.path.join(SOURCE_DIR, f)) for f in filenames]
-    source_image_arrays = [np.array(img) for img in source_images]
+    source_image_arrays = [decode_source(f, use_cache=use_cache, target_size=target_size) for f in filenames]
     return source_image_arrays, filenames
 
 
-def load_sources_half_latest_pairs(n=1):
+def load_sources_half_latest_pairs(n=1, rng=None):
     """
     Return image source pairs, converted into np.ndarray's
         One of each pair will be 'latest', the other randomly picked
 
     :param int n:   Number of source image pairs to grab
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :rtype:         list((np.ndarray, np.ndarray))
     """
     latest, _ = load_sources(latest=True, n=n)
-    randos, _ = load_sources(latest=False, n=n)
+    randos, _ = load_sources(latest=False, n=n, rng=rng)
     return list(zip(latest, randos))
 
 
-def get_random_im_arr():
-    im_arrs, _ = load_sources(latest=False, n=1)
+def get_random_im_arr(rng=None):
+    im_arrs, _ = load_sources(latest=False, n=1, rng=rng)
     return im_arrs[0]
 
 
-def fn_runner(func):
+def fn_runner(func, prepare=None):
+    """
+    Collect func's arguments in a GUI form, and call func with them on every submit
+
+    :param function func:
+    :param function prepare:    If given, called with no arguments before the first call of func
+    :return:
+    """
+    import PySimpleGUI as sg  # Only the GUI runner needs it, see fn_cli for running headless
+
     sg.set_options(font=("Helvetica", 16))
     sg.theme('dark grey 9')  # Add a touch of color
     func_args = get_sig_details(func)
@@ -156,23 +501,81 @@ def fn_runner(func):
             else:  # types [string, bool]
                 arg_val = values[name]
             arg_dict[name] = arg_val
+        if prepare:
+            prepare()
+            prepare = None
         func(**arg_dict)
 
 
-def draw_handle_on_img(img):
+def parse_enum_option(enum_class, opt):
+    """
+    Convert a member name given on the command line (case-insensitive) into a member of enum_class
+
+    :param Enum enum_class:
+    :param str opt:
+    :return Enum:
+    """
+    try:
+        return enum_class[opt.upper()]
+    except KeyError:
+        raise argparse.ArgumentTypeError(f"{opt!r} is not one of {', '.join(enum_class._member_names_)}")
+
+
+def fn_cli(func, argv=None, prepare=None):
+    """
+    Headless counterpart of fn_runner: parse func's arguments from the command line, then call func.
+        Every parameter of func becomes an option (e.g. kern_rate -> --kern-rate 0.9),
+        with the same types and defaults that fn_runner shows.
+        Lists are comma-delimited, Enums are given by member name, and bools are switches (--draw-handle / --no-draw-handle)
+
+    :param function func:
+    :param list(str) argv:  Defaults to sys.argv[1:]
+    :param function prepare:    If given, called with no arguments once the arguments parse, before func.
+                                    So --help and bad arguments exit without preparing anything
+    :return:                Whatever func returns
+    """
+    func_args = get_sig_details(func)
+    parser = argparse.ArgumentParser(description=inspect.getdoc(func))
+    for name, datatype, default_val in func_args:
+        flag = '--' + name.replace('_', '-')
+        typename = datatype.__name__
+        if typename == 'list':
+            parser.add_argument(flag, dest=name, default=default_val, metavar='A,B,...',
+                                type=lambda l_str: l_str.split(',') if l_str else [],
+                                help=f"default: {','.join(default_val)}")
+        elif typename in ('str', 'int', 'float'):
+            parser.add_argument(flag, dest=name, type=datatype, default=default_val, help=f"default: {default_val}")
+        elif typename == 'bool':
+            parser.add_argument(flag, dest=name, action=argparse.BooleanOptionalAction, default=default_val)
+        elif typename == 'Enum':
+            enum_class = default_val.__class__
+            parser.add_argument(flag, dest=name, type=functools.partial(parse_enum_option, enum_class),
+                                default=default_val, metavar='|'.join(enum_class._member_names_),
+                                help=f"default: {default_val.name}")
+        else:
+            raise Exception(f"Unexpected datatype, {name=}, {datatype=}, {default_val=}")
+
+    args = parser.parse_args(argv)
+    if prepare:
+        prepare()
+    return func(**vars(args))
+
+
+def draw_handle_on_img(img, rng=None):
     """
     Draw the "@denomin8r" handle on bottom right of the image then return the image
     :param Image.Image img:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return Image.Image:
     """
+    rng = get_rng(rng)
     TEXT = "@denomin8r"
     w, h = img.size
     draw = ImageDraw.Draw(img)
 
     # Set font object
     fontsize = math.floor(min(w, h) * .03)
-    fontfile = os.path.join(FONT_DIR, BOOKMAN)
-    font_obj = ImageFont.truetype(fontfile, fontsize)
+    font_obj = get_font(BOOKMAN, fontsize)
 
     # Set handle position
     tmp_left, tmp_top, tmp_right, tmp_bottom = draw.textbbox((0,0), TEXT, font=font_obj)
@@ -194,7 +597,7 @@ def draw_handle_on_img(img):
     rectangle_left = ultimate_left + at_radius
 
     # Draw handle region backgrounds
-    bg_color = int(random.random() * 0xffffff)
+    bg_color = int(rng.random() * 0xffffff)
     draw.rectangle(
         ((rectangle_left, ultimate_top), (rectangle_left + text_width + (2 * extra), ultimate_bottom)),
         # (lefttop, rightbottom)
@@ -225,8 +628,7 @@ def draw_test_params(img, **kwargs):
 
     # Set font object
     fontsize = math.floor(h * .025)
-    fontfile = os.path.join(FONT_DIR, BOOKMAN)
-    font_obj = ImageFont.truetype(fontfile, fontsize)
+    font_obj = get_font(BOOKMAN, fontsize)
 
     # Set parameter text
     text = ""
@@ -248,15 +650,16 @@ def draw_test_params(img, **kwargs):
     return img
 
 
-def classic_D_swap_random(im_arr_1=None, im_arr_2=None):
+def classic_D_swap_random(im_arr_1=None, im_arr_2=None, rng=None):
     """
     Make a classic collage with 2 random images and the letter 'D'
 
     :param np.ndarray im_arr_1:
     :param np.ndarray im_arr_2:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
     :return np.ndarray, np.ndarray:
     """
-    im_arrs, _ = load_sources(latest=False, n=2)
+    im_arrs, _ = load_sources(latest=False, n=2, rng=rng)
     if im_arr_1 is None:
         im_arr_1 = im_arrs[0]
     if im_arr_2 is None:
@@ -271,48 +674,288 @@ def classic_D_swap_random(im_arr_1=None, im_arr_2=None):
     return simple_bitmask_swap(im_arr_1, im_arr_2, bitmask)
 
 
-def save_images_from_arrays(im_arrs, draw_handle):
+@instrument_stage()
+def save_images_from_arrays(im_arrs, draw_handle, rng=None):
     """
     Save np.ndarrays to Image.Image with a random ID in the filename
 
     :param list(np.ndarray) im_arrs:
     :param bool draw_handle:
-    :return:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
+    :return list(str):      Paths of the saved images
     """
-
     random_id = uuid.uuid4().__str__().split('-')[0]
+    paths = []
     for i, im_arr in enumerate(im_arrs):
         img = Image.fromarray(im_arr)
 
         if draw_handle:
-            img = draw_handle_on_img(img)
+            img = draw_handle_on_img(img, rng=rng)
+
+        path = f'./output/{random_id}_{i}.jpg'
+        img.save(path)
+        paths.append(path)
+    return paths
+
+
+@instrument_stage()
+def encode_image_from_array(im_arr, draw_handle, rng=None, quality=90):
+    """
+    Encode an np.ndarray as JPEG bytes in memory, e.g. to send it over the network without touching disk
 
-        img.save(f'./output/{random_id}_{i}.jpg')
+    :param np.ndarray im_arr:
+    :param bool draw_handle:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
+    :param int quality:         JPEG quality, 1-95
+    :return bytes:
+    """
+    img = Image.fromarray(im_arr)
+    if draw_handle:
+        img = draw_handle_on_img(img, rng=rng)
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
 
 
-def chaos_source_transform(im_arr):
+class ImageWriter:
+    """
+    Encode and save images on a pool of background threads, so encoding overlaps with rendering.
+        At most max_pending saves wait in the queue; past that, submit() blocks until one finishes.
+        Use as a context manager, or call close(), to flush outstanding saves at the end of a run
+    """
+    def __init__(self, num_threads=2, max_pending=4):
+        self._pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='ImageWriter')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, im_arrs, draw_handle, rng=None, pool=None):
+        """
+        Queue a save_images_from_arrays() call. The arrays must not be modified until it is done
+
+        :param list(np.ndarray) im_arrs:
+        :param bool draw_handle:
+        :param random.Random rng:   Passed to save_images_from_arrays; give each save its own instance,
+                                    since the saves run concurrently
+        :param BufferPool pool:     If given, the arrays are given back to it once saved
+        :return Future:     Resolves to the paths of the saved images
+        """
+        self._slots.acquire()
+        future = self._pool.submit(self._save, STAGE_STATS.current_iteration(), im_arrs, draw_handle, rng, pool)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        return future
+
+    @staticmethod
+    def _save(iteration, im_arrs, draw_handle, rng, pool):
+        # Charge the save to the iteration that submitted it, not the one rendering meanwhile
+        with STAGE_STATS.in_iteration(iteration):
+            paths = save_images_from_arrays(im_arrs, draw_handle, rng)
+        if pool:
+            pool.give(*im_arrs)
+        return paths
+
+    def flush(self):
+        """
+        Wait for every queued save to finish, re-raising the first error
+        :return list(str):  Paths of the images saved since the last flush
+        """
+        futures, self._futures = self._futures, []
+        paths = []
+        for future in futures:
+            paths.extend(future.result())
+        return paths
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown()
+
+
+def open_output_memmap(path, shape):
+    """
+    Create an RGB image array of the given shape backed by a .npy file, so it never has to fit in RAM
+
+    :param str path:
+    :param tuple(int) shape:    (w, h)
+    :return np.memmap:
+    """
+    w, h = shape
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(h, w, 3))
+
+
+def render_tiled_collages(filenames, text, print_shape, out_paths, tile_size=PRINT_TILE_SIZE, kern_rate=1.0,
+                          mask_size=PRINT_MASK_SIZE, fontfile=BOOKMAN):
+    """
+    Render the collage pair of two sources at print size, one tile at a time, into memory-mapped .npy files.
+        Each source is cropped centrally to the print's aspect ratio and resampled up to print size tile by tile.
+        The bitmask is rasterized once at no more than mask_size px per side, and resampled per tile
+        only where the tile overlaps the glyphs. The mask comes out the same for any tile_size;
+        the sources are resampled by PIL per tile, which can round edge pixels differently by a level or so.
+        Peak memory is the two decoded sources, the bitmask and a few tiles, however large the print
+
+    :param list(str) filenames:     Two sources in SOURCE_DIR
+    :param str text:
+    :param tuple(int) print_shape:  (w, h) of the print, in px
+    :param list(str) out_paths:     Two .npy paths for the collages (see simple_bitmask_swap for which is which)
+    :param int tile_size:
+    :param float kern_rate:
+    :param int mask_size:
+    :param str fontfile:
+    :return list(str):              out_paths
+    """
+    print_w, print_h = print_shape
+    aspect = print_w / print_h
+
+    sources = []
+    for filename in filenames:
+        with Image.open(os.path.join(SOURCE_DIR, filename)) as img:
+            img = img.convert('RGB')
+        crop_w, crop_h = get_aspect_crop_shape(img.size, aspect)
+        left, top = (img.width - crop_w) / 2, (img.height - crop_h) / 2
+        sources.append((img, left, top, crop_w / print_w, crop_h / print_h))
+
+    mask_scale = min(1.0, mask_size / max(print_shape))
+    mask_shape = (max(1, round(print_w * mask_scale)), max(1, round(print_h * mask_scale)))
+    bitmask = build_bitmask_to_size(text=text, fontfile=fontfile, shape=mask_shape, kern_rate=kern_rate)
+    mask_w_scale, mask_h_scale = mask_shape[0] / print_w, mask_shape[1] / print_h
+    # The glyphs' bbox in print coordinates, grown by a mask pixel for the resampling filter's reach.
+    #   Tiles only get a mask raster where they overlap it
+    mask_rows, mask_cols = bitmask.bbox
+    padded_raster = np.pad(bitmask.raster[:, :, 0], 1).astype(np.float32)  # Its False border stands for the rest
+
+    def get_mask_coords(start, stop, scale, mask_len, raster_start, padded_len):
+        # Pixel centers in print coordinates, mapped into padded_raster and clamped to the mask's edges
+        coords = np.clip((np.arange(start, stop) + 0.5) * scale - 0.5, 0, mask_len - 1) - raster_start + 1
+        coords = np.clip(coords, 0, padded_len - 1)
+        lo = np.floor(coords).astype(np.intp)
+        return lo, np.minimum(lo + 1, padded_len - 1), (coords - lo).astype(np.float32)
+
+    def resample_mask(left, top, right, bottom):
+        # Bilinear, with every pixel computed from its own print coordinates, so tiling doesn't change the mask
+        x_lo, x_hi, x_frac = get_mask_coords(left, right, mask_w_scale, mask_shape[0], mask_cols.start,
+                                             padded_raster.shape[1])
+        y_lo, y_hi, y_frac = get_mask_coords(top, bottom, mask_h_scale, mask_shape[1], mask_rows.start,
+                                             padded_raster.shape[0])
+        upper, lower = padded_raster[y_lo], padded_raster[y_hi]
+        upper = upper[:, x_lo] * (1 - x_frac) + upper[:, x_hi] * x_frac
+        lower = lower[:, x_lo] * (1 - x_frac) + lower[:, x_hi] * x_frac
+        return (upper * (1 - y_frac)[:, np.newaxis] + lower * y_frac[:, np.newaxis]) > 0.5
+
+    glyph_box = (max(0, math.floor((mask_cols.start - 1) / mask_w_scale)),
+                 max(0, math.floor((mask_rows.start - 1) / mask_h_scale)),
+                 min(print_w, math.ceil((mask_cols.stop + 1) / mask_w_scale)),
+                 min(print_h, math.ceil((mask_rows.stop + 1) / mask_h_scale)))
+
+    outputs = [open_output_memmap(path, print_shape) for path in out_paths]
+    for box in iter_tiles(print_shape, tile_size):
+        left, top, right, bottom = box
+        tile_shape = (right - left, bottom - top)
+        tiles = []
+        for img, crop_left, crop_top, w_scale, h_scale in sources:
+            source_box = (crop_left + left * w_scale, crop_top + top * h_scale,
+                          crop_left + right * w_scale, crop_top + bottom * h_scale)
+            tiles.append(np.asarray(img.resize(tile_shape, Image.Resampling.BICUBIC, box=source_box)))
+        glyph_left, glyph_top = max(left, glyph_box[0]), max(top, glyph_box[1])
+        glyph_right, glyph_bottom = min(right, glyph_box[2]), min(bottom, glyph_box[3])
+        if glyph_left < glyph_right and glyph_top < glyph_bottom:
+            raster = resample_mask(glyph_left, glyph_top, glyph_right, glyph_bottom)[:, :, np.newaxis]
+            mask_tile = PaddedBitmask(raster, (glyph_top - top, glyph_left - left), tile_shape[::-1])
+        else:
+            mask_tile = PaddedBitmask(np.zeros((0, 0, 1), dtype=bool), (0, 0), tile_shape[::-1])
+        simple_bitmask_swap(tiles[0], tiles[1], mask_tile,
+                            out=tuple(output[top:bottom, left:right] for output in outputs))
+
+    for output in outputs:
+        output.flush()
+    return out_paths
+
+
+def export_tiled_tiff(npy_path, tiff_path, tile_size=256):
+    """
+    Convert a rendered .npy print (see render_tiled_collages) to a tiled TIFF, streaming one tile at a time.
+        Needs the optional tifffile package
+
+    :param str npy_path:
+    :param str tiff_path:
+    :param int tile_size:   Multiple of 16
+    :return str:            tiff_path
+    """
+    import tifffile  # Optional, only needed to export prints
+
+    im_arr = np.load(npy_path, mmap_mode='r')
+    h, w = im_arr.shape[:2]
+
+    def tiles():
+        for top in range(0, h, tile_size):
+            for left in range(0, w, tile_size):
+                tile = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)  # Edge tiles are padded
+                part = im_arr[top:top + tile_size, left:left + tile_size]
+                tile[:part.shape[0], :part.shape[1]] = part
+                yield tile
+
+    tifffile.imwrite(tiff_path, tiles(), shape=im_arr.shape, dtype=np.uint8, tile=(tile_size, tile_size),
+                     photometric='rgb', bigtiff=True)
+    return tiff_path
+
+
+def chaos_source_transform(im_arr, rng=None, time_budget_ms=None, pool=None):
     """
     Take an image and run it through a series of transformations, then return the modified image.
-        The number and order of transformations will be determined by chance
+        The number and order of transformations will be determined by chance.
+        Transforms that are pure coordinate remaps (see source_ops.apply_index_remap) are fused and
+        materialized in one gather; any other transform materializes the pending remaps first
 
     :param np.ndarray im_arr:
+    :param random.Random rng:   Source of randomness, defaults to the global random module
+    :param float time_budget_ms: If given, only pick transforms that TRANSFORM_COST_MODEL predicts will fit
+                                    in the time left, at the current size of the image.
+                                    Transforms missing from the model are never picked
+    :param BufferPool pool:     If given, remaps are gathered into buffers taken from it,
+                                    and intermediate results are given back to it
     :return np.ndarray, list[str]:
     """
+    rng = get_rng(rng)
     budget = CHAOS_BUDGET  # Caps the number of transforms you can perform
-    TRANSFORM_FREQ = random.uniform(0.30, 0.50)  # Dictates the likelihood of performing a source transform
+    if time_budget_ms is not None and not (TRANSFORM_COST_MODEL or load_transform_cost_model()):
+        logger.warning("No transform cost model, ignoring time_budget_ms. Run `python bench.py --calibrate`")
+        time_budget_ms = None
+    TRANSFORM_FREQ = rng.uniform(0.30, 0.50)  # Dictates the likelihood of performing a source transform
 
+    pipeline = IndexRemap(im_arr)
     transform_list = []
-    while random.random() < TRANSFORM_FREQ:
-        transform = random.choice(ALL_TRANSFORMS)
+    while rng.random() < TRANSFORM_FREQ:
+        transform = rng.choice(ALL_TRANSFORMS)
         t_cost = transform.transform_cost if transform.transform_cost else COST_LEVEL_3
         if t_cost > budget:
             continue
+        if time_budget_ms is not None:
+            predicted_ms = predict_transform_ms(transform, pipeline.shape)
+            if (predicted_ms is None) or (predicted_ms > time_budget_ms):
+                continue
+            time_budget_ms -= predicted_ms
 
         budget -= t_cost  # Reduce budget because we perform transform
-        im_arr = transform(im_arr)  # Do the transform
+        remap = getattr(transform, 'index_remap', None)
+        if remap:
+            with STAGE_STATS.stage(transform.__name__):
+                pipeline.apply(remap, rng=rng)  # Defer the transform
+        else:
+            im_arr = pipeline.materialize(pool)
+            pipeline = IndexRemap(transform(im_arr, rng=rng))  # Do the transform
+            if pool and not np.may_share_memory(pipeline.im_arr, im_arr):
+                pool.give(im_arr)
         transform_list.append(transform.__name__)
 
         if (budget < 1) or (2 < len(transform_list)):
             break
 
+    with STAGE_STATS.stage('chaos_materialize'):
+        im_arr = pipeline.materialize(pool)
     return im_arr, transform_list